@@ -1,23 +1,55 @@
-from flask import Flask, render_template, jsonify, request, session
-from geopy.geocoders import Nominatim
-import folium
-from folium import plugins
+import time
+_startup_started = time.perf_counter()
+
+from flask import Flask, render_template, jsonify, request, session, make_response, url_for, Response, stream_with_context
 import os
 from dotenv import load_dotenv
 from operator import itemgetter
 import logging
 import json
-from datetime import datetime
-import pytz
+from datetime import datetime, timezone
 import math
 import uuid
 import platform
 import hashlib
-from ua_parser import user_agent_parser
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from threading import Thread
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeoutError
+import atexit
+import click
+from lazy_imports import lazy_module, preload, import_report
+from geo import (calculate_distance, geohash_encode, geohash_center, geohash_cell_radius, geohash_bounds,
+                 is_geohash, geohash_cells_in_bbox)
+from restaurant_cache import TileCache
+from shared_cache import SharedCache
+from singleflight import SingleFlight
+from spatial_index import SpatialIndex
+from ranking import rank_order, rank_restaurants
+from upstream import UpstreamClient, ApiError
+from geocoder import Geocoder, GeocoderBusy
+from boundaries import BoundaryIndex
+from compression import Compressor, precompress, negotiate
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from quota import QuotaBudget, QuotaExceeded, NORMAL, CACHE_ONLY
+from clustering import grid_aggregate, merge_aggregates
+from dedup import merge_candidates
+from name_search import NameIndex, Query, search_store
+from restaurant_store import LiveStore
+from osm_import import import_extract, update_dataset
+
+# Heavy modules are imported on first use to keep worker boot fast
+folium = lazy_module('folium')
+plugins = lazy_module('folium.plugins')
+pytz = lazy_module('pytz')
+user_agent_parser = lazy_module('ua_parser.user_agent_parser')
+smtplib = lazy_module('smtplib')
+mime_text = lazy_module('email.mime.text')
+mime_multipart = lazy_module('email.mime.multipart')
+
+# Modules worth importing up front in the gunicorn master when it preloads the app
+HEAVY_MODULES = [
+    'numpy', 'aiohttp', 'folium', 'folium.plugins', 'pytz',
+    'ua_parser.user_agent_parser', 'smtplib', 'email.mime.text', 'email.mime.multipart'
+]
 
 # Set up logging
 logging.basicConfig(level=logging.DEBUG)
@@ -38,8 +70,240 @@ for directory in [DATA_DIR, USER_DATA_DIR, DEVICE_DATA_DIR, BACKUP_DIR]:
 
 LOCATION_HISTORY_FILE = os.path.join(DATA_DIR, 'location_history.json')
 
+# Restaurant search cache configuration
+SEARCH_CELL_PRECISION = int(os.getenv('SEARCH_CELL_PRECISION', '6'))  # ~1.2km x 0.6km cells
+SEARCH_CACHE_TTL = int(os.getenv('SEARCH_CACHE_TTL', '900'))
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv('SEARCH_CACHE_MAX_ENTRIES', '5000'))
+DEFAULT_SEARCH_RADIUS = 1000  # 1km radius
+MAX_SEARCH_RADIUS = 50000  # Places API limit
+MAX_RESULT_PAGES = 3  # Places returns at most 60 results in pages of 20
+PAGE_TOKEN_DELAY = 2  # seconds before Google activates a next_page_token
+# A cell's search circle is padded to cover the whole cell, so in dense areas much of a page
+# lands outside the caller's circle; further pages are indexed in the background until this
+# many fall inside
+NEARBY_MIN_RESULTS = int(os.getenv('NEARBY_MIN_RESULTS', '10'))
+# Places types and languages searches accept; each pair gets its own tags in the local index
+SEARCH_PLACE_TYPES = tuple(os.getenv('SEARCH_PLACE_TYPES', 'restaurant,cafe,bar,bakery,meal_takeaway').split(','))
+SEARCH_LANGUAGES = tuple(os.getenv('SEARCH_LANGUAGES', 'th,en').split(','))
+# radius=auto searches these radii (meters) in order until enough restaurants are found
+RADIUS_LADDER = tuple(int(radius) for radius in os.getenv('RADIUS_LADDER', '250,500,1000,2000,5000,10000').split(','))
+ADAPTIVE_TARGET_RESULTS = int(os.getenv('ADAPTIVE_TARGET_RESULTS', '10'))
+PREFETCH_WORKERS = int(os.getenv('PREFETCH_WORKERS', '4'))
+# Expired first pages are served for up to this long while a background refresh runs;
+# past it the request waits for the upstream fetch
+SEARCH_CACHE_MAX_STALE = int(os.getenv('SEARCH_CACHE_MAX_STALE', '3600'))
+REFRESH_WORKERS = int(os.getenv('REFRESH_WORKERS', '2'))
+REFRESH_QUEUE_LIMIT = int(os.getenv('REFRESH_QUEUE_LIMIT', '64'))  # refreshes waiting or running
+
+# Viewport (bounding box) search
+VIEWPORT_MAX_TILES = int(os.getenv('VIEWPORT_MAX_TILES', '64'))  # larger views are answered from the index only
+# Uncovered tiles one request may fetch from Places, nearest the view's center first;
+# the rest are answered from the index until later requests cover them
+VIEWPORT_MAX_FETCHES = int(os.getenv('VIEWPORT_MAX_FETCHES', '6'))
+VIEWPORT_MAX_RESULTS = int(os.getenv('VIEWPORT_MAX_RESULTS', '1000'))
+VIEWPORT_FETCH_WORKERS = int(os.getenv('VIEWPORT_FETCH_WORKERS', '8'))
+VIEWPORT_TIMEOUT = float(os.getenv('VIEWPORT_TIMEOUT', '20'))
+
+# Server-side marker clustering
+CLUSTER_CELL_PX = int(os.getenv('CLUSTER_CELL_PX', '60'))  # grid cell size in screen pixels
+CLUSTER_MAX_ZOOM = int(os.getenv('CLUSTER_MAX_ZOOM', '21'))
+CLUSTER_MAX_TILES = int(os.getenv('CLUSTER_MAX_TILES', '64'))
+CLUSTER_CACHE_TTL = int(os.getenv('CLUSTER_CACHE_TTL', '300'))
+CLUSTER_CACHE_MAX_ENTRIES = int(os.getenv('CLUSTER_CACHE_MAX_ENTRIES', '20000'))
+
+# Shared on-disk cache used by all gunicorn workers
+SHARED_CACHE_FILE = os.getenv('SHARED_CACHE_FILE', os.path.join(DATA_DIR, 'shared_cache.sqlite3'))
+SHARED_CACHE_MAX_BYTES = int(os.getenv('SHARED_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+SHARED_CACHE_COMPACT_INTERVAL = int(os.getenv('SHARED_CACHE_COMPACT_INTERVAL', '600'))
+
+# Reverse geocode cache: coordinates snap to geohash cells (precision 8 is ~38m x 19m)
+GEOCODE_CELL_PRECISION = int(os.getenv('GEOCODE_CELL_PRECISION', '8'))
+GEOCODE_CACHE_TTL = int(os.getenv('GEOCODE_CACHE_TTL', str(7 * 24 * 3600)))
+GEOCODE_NEGATIVE_TTL = int(os.getenv('GEOCODE_NEGATIVE_TTL', '3600'))
+GEOCODE_CACHE_MAX_ENTRIES = int(os.getenv('GEOCODE_CACHE_MAX_ENTRIES', '20000'))
+
+# Offline reverse geocoding from administrative boundary polygons (GeoJSON)
+BOUNDARIES_FILE = os.getenv('BOUNDARIES_FILE', os.path.join(DATA_DIR, 'admin_boundaries.geojson'))
+
+# Offline restaurant dataset imported from OpenStreetMap (flask import-osm, flask update-osm);
+# workers look for a newly published generation at most this often
+LOCAL_DATASET_FILE = os.getenv('LOCAL_DATASET_FILE', os.path.join(DATA_DIR, 'restaurants.rstore'))
+LOCAL_DATASET_CHECK_INTERVAL = float(os.getenv('LOCAL_DATASET_CHECK_INTERVAL', '1.0'))
+
+# Places results can be merged with the offline dataset's (off by default, see the README);
+# a Places and an OSM entry are one restaurant when this close (meters) and their names at
+# least this similar (0-1)
+MERGE_LOCAL_RESULTS = os.getenv('MERGE_LOCAL_RESULTS', 'false').lower() == 'true'
+DEDUP_MAX_DISTANCE = float(os.getenv('DEDUP_MAX_DISTANCE', '60'))
+DEDUP_MIN_SIMILARITY = float(os.getenv('DEDUP_MIN_SIMILARITY', '0.5'))
+
+# Search by name: results within this many meters of the user when a position is given
+NAME_SEARCH_RADIUS = int(os.getenv('NAME_SEARCH_RADIUS', '20000'))
+NAME_SEARCH_MAX_RESULTS = int(os.getenv('NAME_SEARCH_MAX_RESULTS', '50'))
+AUTOCOMPLETE_RESULTS = int(os.getenv('AUTOCOMPLETE_RESULTS', '8'))
+NAME_SEARCH_HTTP_MAX_AGE = int(os.getenv('NAME_SEARCH_HTTP_MAX_AGE', '60'))
+
+# Index page map
+MAP_START_COORDS = (float(os.getenv('MAP_START_LAT', '13.7563')), float(os.getenv('MAP_START_LON', '100.5018')))
+MAP_ZOOM_START = int(os.getenv('MAP_ZOOM_START', '15'))
+
+# Upstream HTTP client limits
+UPSTREAM_TIMEOUT = float(os.getenv('UPSTREAM_TIMEOUT', '10'))
+# Views block their thread on each upstream call, so a worker never has more calls in flight
+# than it has request threads (WORKER_THREADS, see gunicorn.conf.py) plus background workers
+WORKER_THREADS = int(os.getenv('WORKER_THREADS', '32'))
+UPSTREAM_MAX_CONCURRENCY = int(os.getenv('UPSTREAM_MAX_CONCURRENCY', str(
+    WORKER_THREADS + PREFETCH_WORKERS + REFRESH_WORKERS + VIEWPORT_FETCH_WORKERS)))
+UPSTREAM_CONNECTIONS_PER_HOST = int(os.getenv('UPSTREAM_CONNECTIONS_PER_HOST', str(UPSTREAM_MAX_CONCURRENCY)))
+
+# Nominatim usage policy: at most 1 request per second
+NOMINATIM_MIN_INTERVAL = float(os.getenv('NOMINATIM_MIN_INTERVAL', '1.0'))
+NOMINATIM_MAX_WAIT = float(os.getenv('NOMINATIM_MAX_WAIT', '3.0'))
+
+# Circuit breaker around Google Places: opens when this share of recent calls failed or were slow
+PLACES_BREAKER_FAILURE_RATIO = float(os.getenv('PLACES_BREAKER_FAILURE_RATIO', '0.5'))
+PLACES_BREAKER_MIN_CALLS = int(os.getenv('PLACES_BREAKER_MIN_CALLS', '5'))
+PLACES_BREAKER_WINDOW = int(os.getenv('PLACES_BREAKER_WINDOW', '60'))
+PLACES_SLOW_CALL_SECONDS = float(os.getenv('PLACES_SLOW_CALL_SECONDS', '5'))
+PLACES_BREAKER_OPEN_SECONDS = int(os.getenv('PLACES_BREAKER_OPEN_SECONDS', '30'))
+
+# Places API budget for the key; 0 means unlimited. Google resets daily quotas at midnight Pacific time
+PLACES_QUOTA_PER_MINUTE = int(os.getenv('PLACES_QUOTA_PER_MINUTE', '0'))
+PLACES_QUOTA_PER_DAY = int(os.getenv('PLACES_QUOTA_PER_DAY', '0'))
+PLACES_QUOTA_TIMEZONE = os.getenv('PLACES_QUOTA_TIMEZONE', 'America/Los_Angeles')
+QUOTA_CONSERVE_RATIO = float(os.getenv('QUOTA_CONSERVE_RATIO', '0.3'))  # budget left when conserving starts
+QUOTA_CACHE_ONLY_RATIO = float(os.getenv('QUOTA_CACHE_ONLY_RATIO', '0.05'))  # daily budget held back entirely
+QUOTA_CONSERVE_TTL_FACTOR = int(os.getenv('QUOTA_CONSERVE_TTL_FACTOR', '4'))
+
+# Restaurants stay in the local index this long after they were last fetched, so they
+# outlive every page that could still be served (stale or conserving budget) but not more;
+# past INDEX_MAX_ITEMS the least recently fetched are dropped first
+INDEX_MAX_ITEMS = int(os.getenv('INDEX_MAX_ITEMS', '200000'))
+INDEX_ITEM_TTL = int(os.getenv('INDEX_ITEM_TTL', str(SEARCH_CACHE_TTL * QUOTA_CONSERVE_TTL_FACTOR
+                                                     + SEARCH_CACHE_MAX_STALE)))
+# Largest limit= a nearby search accepts
+MAX_RESULT_LIMIT = int(os.getenv('MAX_RESULT_LIMIT', '100'))
+
+# HTTP caching of search responses; tile URLs (?cell=...) may be cached by shared caches
+SEARCH_HTTP_MAX_AGE = int(os.getenv('SEARCH_HTTP_MAX_AGE', '300'))
+SEARCH_HTTP_STALE = int(os.getenv('SEARCH_HTTP_STALE', '900'))
+LOCATION_HTTP_MAX_AGE = int(os.getenv('LOCATION_HTTP_MAX_AGE', '86400'))
+LOCATION_HTTP_STALE = int(os.getenv('LOCATION_HTTP_STALE', str(7 * 24 * 3600)))
+
+# Response compression
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', '1024'))  # bytes; smaller bodies gain little
+
 app = Flask(__name__)
 
+# Negotiated gzip/brotli compression of JSON and HTML responses
+Compressor(app, min_size=COMPRESS_MIN_SIZE)
+
+GOOGLE_MAPS_API_KEY = os.getenv('GOOGLE_MAPS_API_KEY')
+
+# Non-blocking Google Places / Nominatim client shared by all threads of the worker
+upstream = UpstreamClient(
+    google_api_key=GOOGLE_MAPS_API_KEY,
+    user_agent="restaurant_finder_app",
+    timeout=UPSTREAM_TIMEOUT,
+    connections_per_host=UPSTREAM_CONNECTIONS_PER_HOST,
+    max_concurrency=UPSTREAM_MAX_CONCURRENCY
+)
+atexit.register(upstream.close)
+
+shared_cache = SharedCache(SHARED_CACHE_FILE, max_bytes=SHARED_CACHE_MAX_BYTES)
+# Compaction runs in a thread, and threads do not survive a fork: under gunicorn every
+# worker starts its own from the post_fork hook (gunicorn.conf.py), see start_worker_tasks()
+
+restaurant_cache = TileCache(max_entries=SEARCH_CACHE_MAX_ENTRIES, ttl=SEARCH_CACHE_TTL,
+                             backend=shared_cache, namespace='restaurant_pages',
+                             stale_ttl=SEARCH_CACHE_MAX_STALE)
+
+geocode_cache = TileCache(max_entries=GEOCODE_CACHE_MAX_ENTRIES, ttl=GEOCODE_CACHE_TTL,
+                          backend=shared_cache, namespace='reverse_geocode_cells')
+
+# Errors that are answers about the request itself rather than signs of an unhealthy upstream
+PLACES_REQUEST_ERRORS = ('INVALID_REQUEST',)
+
+places_breaker = CircuitBreaker(
+    'places',
+    failure_ratio=PLACES_BREAKER_FAILURE_RATIO,
+    min_calls=PLACES_BREAKER_MIN_CALLS,
+    window=PLACES_BREAKER_WINDOW,
+    slow_call_seconds=PLACES_SLOW_CALL_SECONDS,
+    open_seconds=PLACES_BREAKER_OPEN_SECONDS,
+    is_failure=lambda error: not (isinstance(error, ApiError) and error.status in PLACES_REQUEST_ERRORS),
+    not_attempted=lambda error: isinstance(error, QuotaExceeded)
+)
+
+# Places calls counted against the key's budget, shared by all workers through the disk cache
+places_quota = QuotaBudget(
+    'places',
+    api_key=GOOGLE_MAPS_API_KEY,
+    per_minute=PLACES_QUOTA_PER_MINUTE,
+    per_day=PLACES_QUOTA_PER_DAY,
+    timezone=PLACES_QUOTA_TIMEZONE,
+    store=shared_cache,
+    conserve_ratio=QUOTA_CONSERVE_RATIO,
+    cache_only_ratio=QUOTA_CACHE_ONLY_RATIO
+)
+
+# Per tile and zoom cluster aggregates; in process only, they are cheap to rebuild from the index
+cluster_cache = TileCache(max_entries=CLUSTER_CACHE_MAX_ENTRIES, ttl=CLUSTER_CACHE_TTL, namespace='clusters')
+
+# Rate-limited reverse geocoder, slots shared by all workers through the disk cache
+geocoder = Geocoder(upstream, min_interval=NOMINATIM_MIN_INTERVAL, max_wait=NOMINATIM_MAX_WAIT,
+                    store=shared_cache)
+
+def load_boundaries(path):
+    """Load the offline boundary index, or None when no boundary file is available"""
+    if not os.path.exists(path):
+        logger.info(f"No boundary file at {path}, offline reverse geocoding disabled")
+        return None
+    try:
+        return BoundaryIndex.from_file(path)
+    except Exception as e:
+        logger.error(f"Could not load boundaries from {path}: {str(e)}")
+        return None
+
+boundary_index = load_boundaries(BOUNDARIES_FILE)
+
+# Offline dataset, following the generation the dataset path currently points to
+local_dataset = LiveStore(LOCAL_DATASET_FILE, check_interval=LOCAL_DATASET_CHECK_INTERVAL)
+
+# Index page rendered once and served from memory, see get_map_shell(); its validators
+# come from the config and these files, so every worker hands out the same ones
+_map_shell = None
+_map_shell_lock = Lock()
+MAP_SHELL_SOURCES = (os.path.join(app.root_path, 'templates', 'index.html'), os.path.abspath(__file__))
+
+# Collapse concurrent identical upstream lookups into one call
+places_flight = SingleFlight()
+geocode_flight = SingleFlight()
+
+# Local index of the restaurants fetched recently, answers radius and k-nearest queries
+restaurant_index = SpatialIndex(cell_size=float(os.getenv('INDEX_CELL_SIZE', '0.01')),
+                                max_items=INDEX_MAX_ITEMS, item_ttl=INDEX_ITEM_TTL)
+
+# Names of the restaurants fetched recently, searched alongside the offline dataset's
+name_index = NameIndex(max_items=INDEX_MAX_ITEMS, item_ttl=INDEX_ITEM_TTL)
+
+# Background fetching of further result pages
+prefetch_executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix='places-prefetch')
+_pending_prefetches = set()
+_prefetch_lock = Lock()
+
+# Parallel fetching of the missing tiles of viewport searches
+viewport_executor = ThreadPoolExecutor(max_workers=VIEWPORT_FETCH_WORKERS, thread_name_prefix='viewport-fetch')
+
+# Background refreshing of stale cached pages (stale-while-revalidate)
+refresh_executor = ThreadPoolExecutor(max_workers=REFRESH_WORKERS, thread_name_prefix='cache-refresh')
+_pending_refreshes = set()
+_refresh_lock = Lock()
+
+def start_worker_tasks():
+    """Start the background threads a serving process needs, once it is the process that serves"""
+    shared_cache.start_compaction(SHARED_CACHE_COMPACT_INTERVAL)
+
 def get_user_location_file(user_id):
     """Get location history file path for specific user"""
     return os.path.join(USER_DATA_DIR, f'location_history_{user_id}.json')
@@ -64,7 +328,7 @@ def send_location_email(user_data, location_data):
         logger.info(f"Preparing to send email from {sender_email} to {receiver_email}")
         
         # Create message
-        msg = MIMEMultipart()
+        msg = mime_multipart.MIMEMultipart()
         msg['From'] = sender_email
         msg['To'] = receiver_email
         msg['Subject'] = f"New Location Data - User {user_data.get('user_id', 'Unknown')}"
@@ -88,7 +352,7 @@ def send_location_email(user_data, location_data):
         https://www.google.com/maps?q={location_data.get('latitude')},{location_data.get('longitude')}
         """
         
-        msg.attach(MIMEText(location_text, 'plain'))
+        msg.attach(mime_text.MIMEText(location_text, 'plain'))
         
         logger.info("Email content prepared, attempting to send...")
         
@@ -107,6 +371,30 @@ def send_location_email(user_data, location_data):
         logger.error(f"Error preparing email: {str(e)}")
         return False
 
+def reverse_geocode(lat, lon, language=None, timeout=5):
+    """Reverse geocode a coordinate to an address, cached per snapped cell and language"""
+    cell = geohash_encode(float(lat), float(lon), GEOCODE_CELL_PRECISION)
+    cache_key = (cell, language or 'default')
+    cached = geocode_cache.get(cache_key)
+    if cached is not None:
+        return cached['address']
+
+    return geocode_flight.do(cache_key, _reverse_geocode_cell, cache_key, timeout)
+
+def _reverse_geocode_cell(cache_key, timeout):
+    cell, language = cache_key
+    # Look up the cell center so every point in the cell shares one answer
+    center_lat, center_lon = geohash_center(cell)
+    location = geocoder.reverse(center_lat, center_lon,
+                                language=None if language == 'default' else language,
+                                timeout=timeout)
+
+    address = location.get('display_name') if location else None
+    # "No address found" is cached too, for a shorter time
+    ttl = GEOCODE_CACHE_TTL if address is not None else GEOCODE_NEGATIVE_TTL
+    geocode_cache.set(cache_key, {'address': address}, ttl=ttl)
+    return address
+
 def save_user_location(user_id, location_data, device_id):
     """Save user location with device information and send email notification"""
     try:
@@ -140,13 +428,11 @@ def save_user_location(user_id, location_data, device_id):
         
         # Get address
         try:
-            geolocator = Nominatim(user_agent="restaurant_finder_app")
-            location = geolocator.reverse(
-                f"{location_entry['latitude']}, {location_entry['longitude']}", 
-                timeout=5,
+            location_entry['address'] = reverse_geocode(
+                location_entry['latitude'],
+                location_entry['longitude'],
                 language='th'
             )
-            location_entry['address'] = location.address if location else None
         except Exception as e:
             logger.warning(f"Could not get address: {str(e)}")
         
@@ -179,17 +465,544 @@ def save_user_location(user_id, location_data, device_id):
         logger.error(f"Error saving user location: {str(e)}")
         return False
 
-def calculate_distance(lat1, lon1, lat2, lon2):
-    """Calculate distance between two points using Haversine formula"""
-    R = 6371000  # Earth radius in meters
-    phi1 = math.radians(lat1)
-    phi2 = math.radians(lat2)
-    delta_phi = math.radians(lat2 - lat1)
-    delta_lambda = math.radians(lon2 - lon1)
-    
-    a = math.sin(delta_phi/2)**2 + math.cos(phi1) * math.cos(phi2) * math.sin(delta_lambda/2)**2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-    return R * c
+def fetch_cell_page(cell, radius, place_type, language, page_token=None):
+    """Fetch and process one page of restaurants covering a whole geohash cell from Google Places"""
+    if page_token:
+        places_result = _places_next_page(page_token)
+    else:
+        center_lat, center_lon = geohash_center(cell)
+        # Pad the radius so any point inside the cell is covered by the search circle
+        search_radius = min(int(math.ceil(radius + geohash_cell_radius(cell))), MAX_SEARCH_RADIUS)
+
+        places_result = call_places(
+            location=(center_lat, center_lon),
+            radius=search_radius,
+            type=place_type,
+            language=language
+        )
+
+    restaurants = []
+    for place in places_result.get('results', []):
+        restaurant = {
+            'place_id': place.get('place_id'),
+            'name': place.get('name', 'ไม่ระบุชื่อ'),
+            'rating': place.get('rating', 0),
+            'user_ratings_total': place.get('user_ratings_total', 0),
+            'vicinity': place.get('vicinity', 'ไม่ระบุที่อยู่'),
+            'lat': place['geometry']['location']['lat'],
+            'lng': place['geometry']['location']['lng']
+        }
+        restaurants.append(restaurant)
+    return {
+        'restaurants': restaurants,
+        'next_page_token': places_result.get('next_page_token')
+    }
+
+def call_places(**params):
+    """Run a Places nearby search, guarded by the circuit breaker and charged to the quota budget
+
+    The budget is charged inside the breaker, so calls an open circuit
+    rejects never reach Places and cost nothing.
+    """
+    def charged_call():
+        places_quota.acquire()
+        return upstream.places_nearby(**params)
+    return places_breaker.call(charged_call)
+
+def search_cache_ttl():
+    """TTL of freshly fetched pages, stretched while the Places budget is being conserved"""
+    if places_quota.mode() == NORMAL:
+        return SEARCH_CACHE_TTL
+    return SEARCH_CACHE_TTL * QUOTA_CONSERVE_TTL_FACTOR
+
+def _places_next_page(page_token, attempts=3):
+    """Follow a next_page_token, retrying while Google has not activated it yet"""
+    for attempt in range(attempts):
+        try:
+            return call_places(page_token=page_token)
+        except ApiError as e:
+            if e.status != 'INVALID_REQUEST' or attempt == attempts - 1:
+                raise
+            time.sleep(PAGE_TOKEN_DELAY)
+
+def get_cell_page(cell, radius, place_type, language, page=0):
+    """Return one page of a cell's Places results from cache, fetching it if needed"""
+    page_key = (cell, radius, place_type, language, page)
+    cell_page = restaurant_cache.get(page_key)
+    if cell_page is None:
+        logger.debug(f"Cache miss for cell {cell} page {page} (radius={radius}, type={place_type}, language={language})")
+        cell_page = places_flight.do(page_key, _fetch_and_cache_page, page_key)
+    return cell_page
+
+def lookup_cell_page(cell, radius, place_type, language):
+    """Return (first page of a cell's results, seconds it stays fresh)
+
+    A stale page is returned right away and refreshed in the background; only
+    a missing page (never fetched, or stale for longer than
+    SEARCH_CACHE_MAX_STALE) makes the caller wait for the upstream fetch.
+    """
+    page_key = (cell, radius, place_type, language, 0)
+    entry = restaurant_cache.get_entry(page_key)
+    if entry is not None:
+        cell_page, fresh_until = entry
+        fresh_for = fresh_until - time.time()
+        if fresh_for <= 0 and places_quota.mode() != CACHE_ONLY:
+            logger.debug(f"Serving stale cell {cell} ({-fresh_for:.0f}s past its TTL) while refreshing")
+            refresh_cell_page(page_key)
+        return cell_page, max(fresh_for, 0)
+
+    logger.debug(f"Cache miss for cell {cell} page 0 (radius={radius}, type={place_type}, language={language})")
+    cell_page = places_flight.do(page_key, _fetch_and_cache_page, page_key)
+    return cell_page, search_cache_ttl()
+
+def refresh_cell_page(page_key):
+    """Refetch a stale cached page in the background, dropping the refresh when the pool is saturated"""
+    with _refresh_lock:
+        if page_key in _pending_refreshes:
+            return
+        if len(_pending_refreshes) >= REFRESH_QUEUE_LIMIT:
+            logger.warning(f"Refresh queue full, keeping stale page for cell {page_key[0]}")
+            return
+        _pending_refreshes.add(page_key)
+
+    def run():
+        try:
+            places_flight.do(page_key, _fetch_and_cache_page, page_key)
+        except Exception as e:
+            logger.warning(f"Refresh of cell {page_key[0]} failed: {str(e)}")
+        finally:
+            with _refresh_lock:
+                _pending_refreshes.discard(page_key)
+
+    refresh_executor.submit(run)
+
+def _fetch_and_cache_page(page_key):
+    cell, radius, place_type, language, page = page_key
+    page_token = None
+    if page > 0:
+        page_token = get_cell_page(cell, radius, place_type, language, page - 1).get('next_page_token')
+        if not page_token:
+            return {'restaurants': [], 'next_page_token': None}
+
+    try:
+        cell_page = fetch_cell_page(cell, radius, place_type, language, page_token)
+    except ApiError as e:
+        if page_token and e.status == 'INVALID_REQUEST':
+            # The token outlived its cached page; report the end of the results
+            logger.warning(f"Expired page token for cell {cell} page {page}")
+            return {'restaurants': [], 'next_page_token': None}
+        raise
+
+    restaurant_cache.set(page_key, cell_page, ttl=search_cache_ttl())
+    return cell_page
+
+def prefetch_next_page(cell, radius, place_type, language, page):
+    """Fetch the page after `page` in the background so "show more" is served from cache"""
+    next_key = (cell, radius, place_type, language, page + 1)
+    with _prefetch_lock:
+        if next_key in _pending_prefetches:
+            return
+        _pending_prefetches.add(next_key)
+
+    def run():
+        try:
+            # Google only accepts a next_page_token a short while after issuing it
+            time.sleep(PAGE_TOKEN_DELAY)
+            get_cell_page(*next_key)
+            logger.debug(f"Prefetched cell {cell} page {page + 1}")
+        except Exception as e:
+            logger.warning(f"Prefetch of cell {cell} page {page + 1} failed: {str(e)}")
+        finally:
+            with _prefetch_lock:
+                _pending_prefetches.discard(next_key)
+
+    prefetch_executor.submit(run)
+
+def index_next_pages(cell, lat, lon, radius, place_type, language, page=0):
+    """Index the pages after `page` in the background, so the next search near (lat, lon) finds more
+
+    Pages are followed while fewer than NEARBY_MIN_RESULTS indexed
+    restaurants lie within radius of the point; the search that asked
+    returns its first page without waiting for them.
+    """
+    next_key = (cell, radius, place_type, language, page + 1)
+    pending_key = ('index',) + next_key
+    with _prefetch_lock:
+        if pending_key in _pending_prefetches:
+            return
+        _pending_prefetches.add(pending_key)
+
+    def run():
+        try:
+            if restaurant_cache.get(next_key) is None:
+                # Google only accepts a next_page_token a short while after issuing it
+                time.sleep(PAGE_TOKEN_DELAY)
+            cell_page = get_cell_page(*next_key)
+            index_restaurants(cell, radius, place_type, language, cell_page['restaurants'], ttl=0)
+            logger.debug(f"Indexed cell {cell} page {page + 1}")
+        except Exception as e:
+            logger.warning(f"Indexing cell {cell} page {page + 1} failed: {str(e)}")
+            return
+        finally:
+            with _prefetch_lock:
+                _pending_prefetches.discard(pending_key)
+        tag = _index_tag(place_type, language)
+        if (cell_page.get('next_page_token') and page + 2 < MAX_RESULT_PAGES and places_quota.mode() == NORMAL
+                and len(restaurant_index.radius_rows(lat, lon, radius, tag=tag)[0]) < NEARBY_MIN_RESULTS):
+            index_next_pages(cell, lat, lon, radius, place_type, language, page + 1)
+
+    prefetch_executor.submit(run)
+
+def next_page_cursor(cell, radius, place_type, language, page, shown=()):
+    """Return the cursor of the page after `page` and start prefetching it, or None at the end
+
+    The cursor also names the set of place ids shown so far (see
+    save_shown_ids), so the next page can skip them without searching again.
+    """
+    if page + 1 >= MAX_RESULT_PAGES:
+        return None
+    # A stale page still tells whether more results exist
+    entry = restaurant_cache.get_entry((cell, radius, place_type, language, page))
+    if entry is None or not entry[0].get('next_page_token'):
+        return None
+    # Prefetching spends budget on pages that may never be asked for
+    if places_quota.mode() == NORMAL and restaurant_cache.get((cell, radius, place_type, language, page + 1)) is None:
+        prefetch_next_page(cell, radius, place_type, language, page)
+    return f"{page + 1}.{save_shown_ids(shown)}"
+
+def save_shown_ids(place_ids):
+    """Store a set of shown place ids in the shared cache and return its key"""
+    place_ids = sorted(place_ids)
+    token = hashlib.sha1('\n'.join(place_ids).encode()).hexdigest()[:16]
+    # Every request for the same page shows the same ids, so most find them stored already
+    if restaurant_cache.get(('shown', token)) is None:
+        restaurant_cache.set(('shown', token), place_ids, ttl=SEARCH_CACHE_TTL)
+    return token
+
+def load_shown_ids(token):
+    """The place ids saved under token, or an empty set once they expired"""
+    entry = restaurant_cache.get_entry(('shown', token)) if token else None
+    return set(entry[0]) if entry is not None else set()
+
+def unshown_restaurants(restaurants, lat, lon, radius, shown):
+    """Restaurants within radius of a point whose place ids are not in shown, ranked, with their distance"""
+    candidates = [restaurant for restaurant in restaurants
+                  if restaurant['place_id'] is None or restaurant['place_id'] not in shown]
+    distances, order = rank_restaurants(lat, lon,
+                                        [restaurant['lat'] for restaurant in candidates],
+                                        [restaurant['lng'] for restaurant in candidates],
+                                        [restaurant['rating'] or 0 for restaurant in candidates],
+                                        [restaurant['user_ratings_total'] or 0 for restaurant in candidates],
+                                        radius=radius)
+    distances = distances.tolist()
+    return [dict(candidates[i], distance=round(distances[i])) for i in order.tolist()]
+
+def _index_tag(place_type, language, page=0):
+    # Later pages get their own tag so the first page keeps answering default searches
+    return f"{place_type}:{language}" if page == 0 else f"{place_type}:{language}:more"
+
+def restaurant_key(restaurant):
+    """Identity of a restaurant across searches, for indexing and de-duplication"""
+    return restaurant.get('place_id') or (restaurant['name'], restaurant['lat'], restaurant['lng'])
+
+def index_restaurants(cell, radius, place_type, language, restaurants, ttl=SEARCH_CACHE_TTL, page=0):
+    """Add a cell's restaurants to the local indexes and mark the cell as covered for ttl seconds
+
+    Only restaurant searches feed the name index: they cover every eatery
+    the narrower types would add.
+    """
+    tag = _index_tag(place_type, language, page)
+    started = time.time()
+    for restaurant in restaurants:
+        restaurant_index.add(restaurant_key(restaurant), restaurant['lat'], restaurant['lng'], restaurant, tag=tag)
+        if place_type == 'restaurant':
+            name_index.add(restaurant_key(restaurant), restaurant, language)
+    if ttl > 0:
+        restaurant_index.mark_covered(cell, radius, tag=tag, ttl=ttl, since=started)
+
+def rank_nearby(candidates, distances):
+    """Sort by rating (highest first), then review count, nearest first among ties"""
+    order = rank_order(distances,
+                       [restaurant['rating'] or 0 for restaurant in candidates],
+                       [restaurant['user_ratings_total'] or 0 for restaurant in candidates])
+    distances = list(distances)
+    return [dict(candidates[i], distance=round(distances[i])) for i in order.tolist()]
+
+def search_restaurants(lat, lon, radius=DEFAULT_SEARCH_RADIUS, place_type='restaurant', language='th', limit=None):
+    """Search restaurants around a point, answered from the local index when the cell is covered"""
+    cell = geohash_encode(lat, lon, SEARCH_CELL_PRECISION)
+    tag = _index_tag(place_type, language)
+
+    if restaurant_index.is_covered(cell, radius, tag=tag):
+        logger.debug(f"Local index hit for cell {cell} (radius={radius}, type={place_type}, language={language})")
+    else:
+        cell_page, fresh_for = lookup_cell_page(cell, radius, place_type, language)
+        # Stale pages are indexed but leave the cell uncovered until the refresh lands
+        index_restaurants(cell, radius, place_type, language, cell_page['restaurants'], ttl=fresh_for)
+
+        if (cell_page.get('next_page_token') and places_quota.mode() == NORMAL
+                and len(restaurant_index.radius_rows(lat, lon, radius, tag=tag)[0]) < NEARBY_MIN_RESULTS):
+            logger.debug(f"Only part of cell {cell} falls within {radius}m, indexing its next pages")
+            index_next_pages(cell, lat, lon, radius, place_type, language)
+
+    # Distances are measured from the caller's exact position
+    if limit:
+        rows, distances = restaurant_index.nearest_rows(lat, lon, limit, max_radius=radius, tag=tag)
+    else:
+        rows, distances = restaurant_index.radius_rows(lat, lon, radius, tag=tag)
+    return rank_nearby(restaurant_index.items(rows), distances.tolist())
+
+def search_restaurants_adaptive(lat, lon, place_type='restaurant', language='th', target=ADAPTIVE_TARGET_RESULTS, limit=None):
+    """Search the smallest RADIUS_LADDER radius expected to hold at least `target` restaurants
+
+    Radii whose whole circle the local index covers are answered from it,
+    smallest first. Past them, one radius is picked from the density seen
+    at the largest covered radius (or in the offline dataset, or
+    DEFAULT_SEARCH_RADIUS without either) and only that one is searched, so
+    a request costs at most one upstream search whatever the target.
+
+    Returns (restaurants, next_cursor, radius); the restaurants may fall
+    short of the target when the picked radius holds fewer.
+    """
+    tag = _index_tag(place_type, language)
+    cell = geohash_encode(lat, lon, SEARCH_CELL_PRECISION)
+    if limit:
+        target = min(target, limit)
+
+    needed = None
+    for radius in RADIUS_LADDER:
+        if not restaurant_index.is_covered(cell, radius, tag=tag):
+            break
+        rows, distances = restaurant_index.radius_rows(lat, lon, radius, tag=tag)
+        if len(rows) >= target or radius == RADIUS_LADDER[-1]:
+            restaurants = rank_nearby(restaurant_index.items(rows), distances.tolist())
+            return restaurants[:limit] if limit else restaurants, None, radius
+        # Counts grow with the area, so aim for the radius expected to hold the target
+        needed = radius * math.sqrt(target / max(len(rows), 1))
+
+    if needed is None:
+        needed = local_radius(lat, lon, place_type, target) if local_dataset.current() is not None else DEFAULT_SEARCH_RADIUS
+    radius = next((radius for radius in RADIUS_LADDER if radius >= needed), RADIUS_LADDER[-1])
+    logger.debug(f"Searching {radius}m for {target} restaurants near lat: {lat}, lon: {lon}")
+    if limit:
+        return search_restaurants(lat, lon, radius, place_type, language, limit), None, radius
+    restaurants, next_cursor = search_restaurants_page(lat, lon, radius, place_type, language)
+    return restaurants, next_cursor, radius
+
+def fetch_viewport_tile(tile, place_type, language):
+    """Fetch the first page of a viewport tile, index it and return its restaurants"""
+    # Tiles are search cells, so the page nearby searches cache for the cell serves here too
+    cell_page, fresh_for = lookup_cell_page(tile, DEFAULT_SEARCH_RADIUS, place_type, language)
+    index_restaurants(tile, DEFAULT_SEARCH_RADIUS, place_type, language, cell_page['restaurants'], ttl=fresh_for)
+    return cell_page['restaurants']
+
+def stream_viewport(south, west, north, east, place_type='restaurant', language='th'):
+    """Yield NDJSON lines with the restaurants inside a bounding box
+
+    The first line holds what the local index already has. The box is then
+    split into search tiles, and up to VIEWPORT_MAX_FETCHES of the tiles not
+    yet covered, the most central first, are fetched in parallel while the
+    Places budget is not being conserved. Each finished tile adds a line
+    with the restaurants not sent before. A final line summarizes the tiles.
+    """
+    tag = _index_tag(place_type, language)
+    sent = set()
+    truncated = False
+
+    def batch(restaurants):
+        nonlocal truncated
+        fresh = []
+        for restaurant in restaurants:
+            if not (south <= restaurant['lat'] <= north and west <= restaurant['lng'] <= east):
+                continue
+            key = restaurant_key(restaurant)
+            if key in sent:
+                continue
+            if len(sent) >= VIEWPORT_MAX_RESULTS:
+                truncated = True
+                break
+            sent.add(key)
+            fresh.append(restaurant)
+        return fresh
+
+    indexed = batch(restaurant_index.items(restaurant_index.bbox_rows(south, west, north, east, tag=tag)))
+    yield json.dumps({'tile': None, 'restaurants': indexed}, ensure_ascii=False) + '\n'
+
+    tiles = geohash_cells_in_bbox(south, west, north, east, SEARCH_CELL_PRECISION, max_cells=VIEWPORT_MAX_TILES)
+    missing = [tile for tile in tiles or [] if not restaurant_index.is_covered(tile, 0, tag=tag)]
+    center_lat, center_lon = (south + north) / 2, (west + east) / 2
+    missing.sort(key=lambda tile: calculate_distance(center_lat, center_lon, *geohash_center(tile)))
+    fetch_limit = VIEWPORT_MAX_FETCHES if places_quota.mode() == NORMAL else 0
+    skipped = len(missing[fetch_limit:])
+    missing = missing[:fetch_limit]
+    futures = {viewport_executor.submit(fetch_viewport_tile, tile, place_type, language): tile for tile in missing}
+
+    failed = 0
+    try:
+        for future in as_completed(futures, timeout=VIEWPORT_TIMEOUT):
+            tile = futures[future]
+            try:
+                restaurants = batch(future.result())
+            except Exception as e:
+                logger.warning(f"Viewport tile {tile} failed: {str(e)}")
+                failed += 1
+                continue
+            if restaurants:
+                yield json.dumps({'tile': tile, 'restaurants': restaurants}, ensure_ascii=False) + '\n'
+    except FutureTimeoutError:
+        # Unfinished tiles keep fetching in the background and land in the cache
+        failed += sum(1 for future in futures if not future.done())
+        logger.warning(f"Viewport search timed out with {failed} tiles missing")
+
+    yield json.dumps({
+        'done': True,
+        'tiles': len(tiles) if tiles is not None else None,
+        'fetched': len(missing) - failed,
+        'failed': failed,
+        'skipped': skipped,
+        'count': len(sent),
+        # Too many tiles to fetch, or more results than one response carries
+        'complete': tiles is not None and not failed and not skipped and not truncated
+    }) + '\n'
+
+def tile_clusters(tile, zoom, tag):
+    """Grid aggregates of the indexed restaurants in one tile at a zoom level, cached
+
+    The key includes the index's version of the tile's area, so a hit
+    needs no index query, and changes there (but not elsewhere) show up
+    without waiting for the entry to expire.
+    """
+    key = (tile, zoom, tag, restaurant_index.bbox_version(*geohash_bounds(tile)))
+    aggregates = cluster_cache.get(key)
+    if aggregates is None:
+        rows = restaurant_index.bbox_rows(*geohash_bounds(tile), tag=tag)
+        lats, lons = restaurant_index.coordinates(rows)
+        aggregates = grid_aggregate(lats, lons, restaurant_index.items(rows), zoom, CLUSTER_CELL_PX)
+        cluster_cache.set(key, aggregates)
+    return aggregates
+
+def cluster_viewport(south, west, north, east, zoom, place_type='restaurant', language='th'):
+    """Clusters of the indexed restaurants covering a viewport at a zoom level
+
+    The viewport is split into geohash tiles, coarser ones for larger views so
+    the work stays bounded; the tiles' cached aggregates are merged on a
+    global pixel grid. Returns None when the view is too large even then.
+    """
+    tag = _index_tag(place_type, language)
+    for precision in range(SEARCH_CELL_PRECISION, 0, -1):
+        tiles = geohash_cells_in_bbox(south, west, north, east, precision, max_cells=CLUSTER_MAX_TILES)
+        if tiles is not None:
+            return merge_aggregates(tile_clusters(tile, zoom, tag) for tile in tiles)
+    return None
+
+def _local_kinds(store, place_type):
+    """Dataset kinds matching a Places type: restaurant covers every eatery, cafe and the like narrow it"""
+    return None if place_type == 'restaurant' or place_type not in store.kinds else [place_type]
+
+def local_restaurants(lat, lon, radius, place_type='restaurant', limit=None):
+    """Restaurants within radius from the offline dataset, ranked like Places results"""
+    store = local_dataset.current()
+    if store is None:
+        return []
+    rows, distances = store.radius_rows(lat, lon, radius, kinds=_local_kinds(store, place_type))
+    # Rank on the mapped columns so only the rows returned get their strings decoded
+    order = rank_order(distances, store.columns['rating'][rows], store.columns['reviews'][rows])
+    if limit:
+        order = order[:limit]
+    distances = distances[order].tolist()
+    return [dict(restaurant, distance=round(distance))
+            for restaurant, distance in zip(store.restaurants(rows[order]), distances)]
+
+def merge_sources(restaurants, limit=None):
+    """Deduplicate restaurants gathered from several sources and rank the result"""
+    merged = merge_candidates(restaurants, DEDUP_MAX_DISTANCE, DEDUP_MIN_SIMILARITY)
+    merged = rank_nearby(merged, [restaurant['distance'] for restaurant in merged])
+    return merged[:limit] if limit else merged
+
+def with_local_results(lat, lon, radius, place_type, restaurants, limit=None):
+    """Places results merged with the offline dataset's restaurants in the same circle"""
+    local = local_restaurants(lat, lon, radius, place_type)
+    if not local:
+        return restaurants
+    return merge_sources(restaurants + local, limit)
+
+def search_names(query, lat=None, lon=None, radius=None, limit=10):
+    """Restaurants whose Thai or English name contains query, best match first
+
+    Searches the offline dataset and everything fetched from Places, merges
+    the duplicates between them and ranks by text match, distance and
+    rating (see name_search.scores).
+    """
+    query = Query(query)
+    if not query.valid:
+        return []
+    matches = name_index.search(query, lat, lon, radius, limit)
+    store = local_dataset.current()
+    if store is not None:
+        matches += search_store(store, query, lat, lon, radius, limit)
+    matches.sort(key=lambda match: match[0], reverse=True)
+    # Sorted first, so every merged restaurant keeps its best scoring source's identity
+    return merge_candidates([restaurant for _, restaurant in matches],
+                            DEDUP_MAX_DISTANCE, DEDUP_MIN_SIMILARITY)[:limit]
+
+def local_radius(lat, lon, place_type='restaurant', target=ADAPTIVE_TARGET_RESULTS):
+    """Smallest RADIUS_LADDER step holding target restaurants in the offline dataset"""
+    store = local_dataset.current()
+    if store is None:
+        return RADIUS_LADDER[-1]
+    kinds = _local_kinds(store, place_type)
+    for radius in RADIUS_LADDER:
+        if len(store.radius_rows(lat, lon, radius, kinds=kinds)[0]) >= target:
+            return radius
+    return RADIUS_LADDER[-1]
+
+def fallback_restaurants(lat, lon, radius, place_type, language, limit=None):
+    """Best-effort results without Places, for when it cannot be reached
+
+    Returns what was indexed within radius merged with the offline dataset
+    within radius, or else the nearest indexed restaurants up to
+    MAX_SEARCH_RADIUS away; coverage is ignored, so results may be partial.
+    """
+    tag = _index_tag(place_type, language)
+    rows, distances = restaurant_index.radius_rows(lat, lon, radius, tag=tag)
+    local = local_restaurants(lat, lon, radius, place_type)
+    if local:
+        return merge_sources(rank_nearby(restaurant_index.items(rows), distances.tolist()) + local, limit)
+    if not len(rows):
+        rows, distances = restaurant_index.nearest_rows(lat, lon, limit or 20, max_radius=MAX_SEARCH_RADIUS, tag=tag)
+    restaurants = rank_nearby(restaurant_index.items(rows), distances.tolist())
+    return restaurants[:limit] if limit else restaurants
+
+def search_restaurants_page(lat, lon, radius=DEFAULT_SEARCH_RADIUS, place_type='restaurant', language='th', page=0,
+                            shown_token=None):
+    """Return (restaurants, next_cursor) for one page of results around a point
+
+    Later pages skip the place ids earlier pages showed (shown_token, from
+    the cursor), and pages with nothing left to show are passed over: the
+    first page may already show them, once they were indexed in the
+    background (see index_next_pages).
+    """
+    cell = geohash_encode(lat, lon, SEARCH_CELL_PRECISION)
+    if page == 0:
+        restaurants = search_restaurants(lat, lon, radius, place_type, language)
+        shown = {restaurant['place_id'] for restaurant in restaurants if restaurant['place_id']}
+        while page + 1 < MAX_RESULT_PAGES:
+            cell_page = restaurant_cache.get((cell, radius, place_type, language, page + 1))
+            if cell_page is None or unshown_restaurants(cell_page['restaurants'], lat, lon, radius, shown):
+                break
+            page += 1
+    else:
+        shown = load_shown_ids(shown_token)
+        while True:
+            cell_page = get_cell_page(cell, radius, place_type, language, page)
+            index_restaurants(cell, radius, place_type, language, cell_page['restaurants'], page=page)
+            restaurants = unshown_restaurants(cell_page['restaurants'], lat, lon, radius, shown)
+            if restaurants or page + 1 >= MAX_RESULT_PAGES or not cell_page.get('next_page_token'):
+                break
+            page += 1
+        shown.update(restaurant['place_id'] for restaurant in restaurants if restaurant['place_id'])
+
+    return restaurants, next_page_cursor(cell, radius, place_type, language, page, shown)
 
 def get_device_info():
     """Get detailed device information from request"""
@@ -217,21 +1030,98 @@ def get_device_info():
             'timestamp': datetime.now(pytz.timezone('Asia/Bangkok')).isoformat()
         }
 
-@app.route('/')
-def index():
+def map_config():
+    """Settings the index page map is rendered from"""
+    return {
+        'location': MAP_START_COORDS,
+        'zoom_start': MAP_ZOOM_START,
+        'locate_auto_start': True,
+        # The page requests address tile URLs, so it must snap to the same cells as the server
+        'geocode_cell_precision': GEOCODE_CELL_PRECISION,
+        # Template edits (e.g. during development) also invalidate the shell
+        'template_mtime': os.path.getmtime(os.path.join(app.root_path, app.template_folder, 'index.html'))
+    }
+
+def render_map_shell(config):
+    """Render the index page with its Folium map"""
     # Create a map centered at a default location (Bangkok)
-    start_coords = (13.7563, 100.5018)
-    folium_map = folium.Map(location=start_coords, 
-                           zoom_start=15,
+    folium_map = folium.Map(location=config['location'], 
+                           zoom_start=config['zoom_start'],
                            width='100%',
                            height='100%')
     
     # Add locate control
-    plugins.LocateControl(auto_start=True).add_to(folium_map)
+    plugins.LocateControl(auto_start=config['locate_auto_start']).add_to(folium_map)
     
     # Convert map to HTML
     map_html = folium_map._repr_html_()
-    return render_template('index.html', map=map_html)
+    return render_template('index.html', map=map_html,
+                           geocode_cell_precision=config['geocode_cell_precision'])
+
+def get_map_shell():
+    """Return the rendered index page, rendering it again only when its config changes"""
+    global _map_shell
+    config = map_config()
+    config_key = hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+    shell = _map_shell
+    if shell is None or shell['config_key'] != config_key:
+        with _map_shell_lock:
+            shell = _map_shell
+            if shell is None or shell['config_key'] != config_key:
+                html = render_map_shell(config).encode('utf-8')
+                # Folium gives its elements random ids, so the html differs between renders
+                # and workers; the validators are derived from what it is rendered from instead
+                modified = int(max(os.path.getmtime(path) for path in MAP_SHELL_SOURCES))
+                version = f"{config_key}:{modified}:{folium.__version__}"
+                shell = {
+                    'config_key': config_key,
+                    # Compressed once here instead of on every request
+                    'bodies': precompress(html),
+                    'etag': hashlib.sha1(version.encode()).hexdigest(),
+                    'last_modified': datetime.fromtimestamp(modified, timezone.utc)
+                }
+                _map_shell = shell
+                sizes = ', '.join(f"{encoding} {len(body)}" for encoding, body in shell['bodies'].items())
+                logger.info(f"Rendered index map shell ({sizes} bytes)")
+    return shell
+
+def cached_json(payload, max_age, stale_while_revalidate, shared=True, canonical_url=None):
+    """JSON response with a payload-derived ETag and Cache-Control, or 304 if the client's copy is current
+
+    shared=False keeps the response out of shared caches, e.g. when the URL
+    holds a user's exact position; canonical_url then points to the tile URL.
+    """
+    response = jsonify(payload)
+    # Weak, so one validator covers the identity and compressed variants
+    response.set_etag(hashlib.sha1(response.get_data()).hexdigest(), weak=True)
+    if shared:
+        response.cache_control.public = True
+    else:
+        response.cache_control.private = True
+    response.cache_control.max_age = max_age
+    response.cache_control.stale_while_revalidate = stale_while_revalidate
+    if canonical_url:
+        response.headers['Link'] = f'<{canonical_url}>; rel="canonical"'
+    return response.make_conditional(request)
+
+@app.route('/')
+def index():
+    shell = get_map_shell()
+    encoding = negotiate(request.accept_encodings)
+    response = make_response(shell['bodies'][encoding])
+    response.mimetype = 'text/html'
+    response.vary.add('Accept-Encoding')
+    # Weak: renders with the same validator differ in folium's element ids
+    if encoding == 'identity':
+        response.set_etag(shell['etag'], weak=True)
+    else:
+        response.headers['Content-Encoding'] = encoding
+        response.set_etag(f"{shell['etag']}-{encoding}", weak=True)
+    response.last_modified = shell['last_modified']
+    # Let browsers keep the page but revalidate it on every visit
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 @app.route('/track', methods=['POST'])
 def track_user():
@@ -303,22 +1193,50 @@ def get_location():
     try:
         lat = request.args.get('lat')
         lon = request.args.get('lon')
+        cell = request.args.get('cell')
         
-        if not lat or not lon:
+        if cell:
+            if not is_geohash(cell, GEOCODE_CELL_PRECISION):
+                return jsonify({
+                    'status': 'error',
+                    'message': 'Invalid cell'
+                }), 400
+            lat, lon = geohash_center(cell)
+        elif not lat or not lon:
             return jsonify({
                 'status': 'error',
                 'message': 'Missing coordinates'
             })
-            
-        geolocator = Nominatim(user_agent="my_web_app")
-        location = geolocator.reverse(f"{lat}, {lon}")
+
+        language = request.args.get('language')
+        detail = request.args.get('detail', 'district')
+
+        # District-level addresses come from local polygons; only street detail needs Nominatim
+        address = None
+        source = 'offline'
+        if detail != 'street' and boundary_index is not None:
+            address = boundary_index.address(float(lat), float(lon), language=language)
+        if address is None:
+            address = reverse_geocode(lat, lon, language=language)
+            source = 'nominatim'
         
-        return jsonify({
+        canonical_url = url_for('get_location',
+                                cell=cell or geohash_encode(float(lat), float(lon), GEOCODE_CELL_PRECISION),
+                                language=language, detail=detail)
+        return cached_json({
             'status': 'success',
             'lat': float(lat),
             'lon': float(lon),
-            'address': location.address if location else 'ไม่พบข้อมูลที่อยู่'
-        })
+            'address': address or 'ไม่พบข้อมูลที่อยู่',
+            'source': source
+        }, LOCATION_HTTP_MAX_AGE, LOCATION_HTTP_STALE,
+            shared=bool(cell), canonical_url=None if cell else canonical_url)
+    except GeocoderBusy:
+        logger.warning(f"Geocoder busy, dropping lookup for lat={lat}, lon={lon}")
+        return jsonify({
+            'status': 'error',
+            'message': 'ระบบค้นหาที่อยู่กำลังทำงานหนัก กรุณาลองใหม่อีกครั้ง'
+        }), 503
     except Exception as e:
         logger.error(f"Error in get_location: {str(e)}")
         return jsonify({
@@ -331,71 +1249,159 @@ def get_nearby_restaurants():
     try:
         lat = request.args.get('lat')
         lon = request.args.get('lon')
+        cell = request.args.get('cell')
         
-        if not lat or not lon:
-            logger.warning("Missing coordinates in get_nearby_restaurants request")
-            return jsonify({
-                'status': 'error',
-                'message': 'กรุณาระบุตำแหน่งของคุณ'
-            }), 400
+        if cell:
+            # Tile URL: search from the cell center so everyone in the cell shares one response;
+            # distances and the radius are then measured from the center, not the caller
+            if not is_geohash(cell, SEARCH_CELL_PRECISION):
+                return jsonify({
+                    'status': 'error',
+                    'message': 'พิกัดไม่ถูกต้อง'
+                }), 400
+            lat, lon = geohash_center(cell)
+        else:
+            if not lat or not lon:
+                logger.warning("Missing coordinates in get_nearby_restaurants request")
+                return jsonify({
+                    'status': 'error',
+                    'message': 'กรุณาระบุตำแหน่งของคุณ'
+                }), 400
+
+            try:
+                lat = float(lat)
+                lon = float(lon)
+            except ValueError:
+                logger.error(f"Invalid coordinates: lat={lat}, lon={lon}")
+                return jsonify({
+                    'status': 'error',
+                    'message': 'พิกัดไม่ถูกต้อง'
+                }), 400
+
+        logger.debug(f"Searching for restaurants near lat: {lat}, lon: {lon}")
 
+        # radius=auto widens the search until min_results restaurants are found
+        adaptive = request.args.get('radius') == 'auto'
+        min_results = request.args.get('min_results', type=int)
+        if min_results is not None:
+            # Larger targets would only widen searches to radii nobody scrolls through
+            min_results = max(1, min(min_results, ADAPTIVE_TARGET_RESULTS * 2))
+        radius = DEFAULT_SEARCH_RADIUS
+        if not adaptive:
+            try:
+                radius = int(request.args.get('radius', DEFAULT_SEARCH_RADIUS))
+                radius = max(1, min(radius, MAX_SEARCH_RADIUS))
+            except ValueError:
+                radius = DEFAULT_SEARCH_RADIUS
         try:
-            lat = float(lat)
-            lon = float(lon)
+            place_type, language = search_filter_args()
         except ValueError:
-            logger.error(f"Invalid coordinates: lat={lat}, lon={lon}")
-            return jsonify({
-                'status': 'error',
-                'message': 'พิกัดไม่ถูกต้อง'
-            }), 400
+            return invalid_filter_response()
+        limit = request.args.get('limit', type=int)
+        if limit is not None:
+            limit = max(1, min(limit, MAX_RESULT_LIMIT))
+        # source=local answers from the offline OSM dataset without calling Places
+        local = request.args.get('source') == 'local'
 
-        logger.debug(f"Searching for restaurants near lat: {lat}, lon: {lon}")
+        # Cursors are "<page>.<key of the place ids shown so far>"
+        cursor = request.args.get('cursor')
+        page = 0
+        shown_token = None
+        if cursor:
+            page_text, _, shown_token = cursor.partition('.')
+            try:
+                page = int(page_text)
+            except ValueError:
+                page = -1
+            # Further pages are asked for with the radius the first page settled on; limited
+            # searches answer from the index in one go and have no further pages
+            if not 0 < page < MAX_RESULT_PAGES or adaptive or local or limit:
+                return jsonify({
+                    'status': 'error',
+                    'message': 'cursor ไม่ถูกต้อง'
+                }), 400
+
+        canonical_args = {'cell': cell or geohash_encode(lat, lon, SEARCH_CELL_PRECISION),
+                          'radius': 'auto' if adaptive else radius, 'type': place_type, 'language': language}
+        if adaptive and min_results:
+            canonical_args['min_results'] = min_results
+        if limit:
+            canonical_args['limit'] = limit
+        if page:
+            canonical_args['cursor'] = cursor
+        if local:
+            canonical_args['source'] = 'local'
+        cache_args = {'shared': bool(cell),
+                      'canonical_url': None if cell else url_for('get_nearby_restaurants', **canonical_args)}
 
         try:
             # Search for nearby restaurants
-            places_result = gmaps.places_nearby(
-                location=(lat, lon),
-                radius=1000,  # 1km radius
-                type='restaurant',
-                language='th'
-            )
+            if local:
+                if local_dataset.current() is None:
+                    return jsonify({
+                        'status': 'error',
+                        'message': 'ไม่มีข้อมูลร้านอาหารแบบออฟไลน์'
+                    }), 503
+                if adaptive:
+                    radius = local_radius(lat, lon, place_type, min_results or ADAPTIVE_TARGET_RESULTS)
+                restaurants = local_restaurants(lat, lon, radius, place_type, limit)
+                next_cursor = None
+            elif adaptive:
+                restaurants, next_cursor, radius = search_restaurants_adaptive(
+                    lat, lon, place_type, language, min_results or ADAPTIVE_TARGET_RESULTS, limit)
+            elif limit:
+                restaurants = search_restaurants(lat, lon, radius, place_type, language, limit)
+                next_cursor = None
+            else:
+                restaurants, next_cursor = search_restaurants_page(lat, lon, radius, place_type, language, page,
+                                                                   shown_token)
 
-            if not places_result.get('results'):
+            if MERGE_LOCAL_RESULTS and not local and not page:
+                restaurants = with_local_results(lat, lon, radius, place_type, restaurants, limit)
+
+            if not restaurants and not next_cursor:
                 logger.info(f"No restaurants found near lat: {lat}, lon: {lon}")
-                return jsonify({
+                return cached_json({
                     'status': 'success',
                     'message': 'ไม่พบร้านอาหารในบริเวณนี้',
-                    'restaurants': []
-                })
-
-            # Process and sort restaurants
-            restaurants = []
-            for place in places_result.get('results', []):
-                restaurant = {
-                    'name': place.get('name', 'ไม่ระบุชื่อ'),
-                    'rating': place.get('rating', 0),
-                    'user_ratings_total': place.get('user_ratings_total', 0),
-                    'vicinity': place.get('vicinity', 'ไม่ระบุที่อยู่'),
-                    'lat': place['geometry']['location']['lat'],
-                    'lng': place['geometry']['location']['lng']
-                }
-                restaurants.append(restaurant)
-
-            # Sort by rating (highest first)
-            restaurants.sort(key=lambda x: (x['rating'] or 0, x['user_ratings_total'] or 0), reverse=True)
+                    'restaurants': [],
+                    'next_cursor': None,
+                    'radius': radius
+                }, SEARCH_HTTP_MAX_AGE, SEARCH_HTTP_STALE, **cache_args)
 
             logger.debug(f"Successfully found {len(restaurants)} restaurants")
-            return jsonify({
+            return cached_json({
                 'status': 'success',
-                'restaurants': restaurants
-            })
+                'restaurants': restaurants,
+                'next_cursor': next_cursor,
+                'radius': radius
+            }, SEARCH_HTTP_MAX_AGE, SEARCH_HTTP_STALE, **cache_args)
 
         except Exception as e:
-            logger.error(f"Google Maps API error: {str(e)}")
-            return jsonify({
-                'status': 'error',
-                'message': 'เกิดข้อผิดพลาดในการค้นหาร้านอาหาร'
-            }), 500
+            if isinstance(e, CircuitOpenError):
+                logger.warning(f"Places circuit open, serving local results near lat: {lat}, lon: {lon}")
+            elif isinstance(e, QuotaExceeded):
+                logger.warning(f"Places budget exhausted, serving local results near lat: {lat}, lon: {lon}")
+            else:
+                logger.error(f"Google Maps API error: {str(e)}")
+
+            # Later pages have nothing to add without Places; the first page falls back to the index
+            restaurants = [] if page else fallback_restaurants(lat, lon, radius, place_type, language, limit)
+            if not restaurants and not page:
+                return jsonify({
+                    'status': 'error',
+                    'message': 'เกิดข้อผิดพลาดในการค้นหาร้านอาหาร'
+                }), 500
+
+            response = jsonify({
+                'status': 'success',
+                'restaurants': restaurants,
+                'next_cursor': None,
+                'degraded': True
+            })
+            # Partial results must not be kept by browsers or shared caches
+            response.cache_control.no_store = True
+            return response
 
     except Exception as e:
         logger.error(f"Unexpected error in get_nearby_restaurants: {str(e)}")
@@ -404,6 +1410,172 @@ def get_nearby_restaurants():
             'message': 'เกิดข้อผิดพลาดที่ไม่คาดคิด กรุณาลองใหม่อีกครั้ง'
         }), 500
 
+@app.route('/get_restaurants_in_view')
+def get_restaurants_in_view():
+    """Stream the restaurants inside a map viewport as NDJSON, see stream_viewport()"""
+    try:
+        south, west, north, east = (float(request.args[name]) for name in ('south', 'west', 'north', 'east'))
+    except (KeyError, ValueError):
+        return jsonify({
+            'status': 'error',
+            'message': 'กรุณาระบุขอบเขตแผนที่'
+        }), 400
+    if not (-90 <= south < north <= 90 and -180 <= west < east <= 180):
+        return jsonify({
+            'status': 'error',
+            'message': 'ขอบเขตแผนที่ไม่ถูกต้อง'
+        }), 400
+
+    try:
+        place_type, language = search_filter_args()
+    except ValueError:
+        return invalid_filter_response()
+    response = Response(stream_with_context(stream_viewport(south, west, north, east, place_type, language)),
+                        mimetype='application/x-ndjson')
+    # Let proxies pass each line on as soon as it is written
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/get_restaurant_clusters')
+def get_restaurant_clusters():
+    """Indexed restaurants in a viewport grouped into clusters for a map zoom level"""
+    try:
+        south, west, north, east = (float(request.args[name]) for name in ('south', 'west', 'north', 'east'))
+        zoom = int(request.args['zoom'])
+    except (KeyError, ValueError):
+        return jsonify({
+            'status': 'error',
+            'message': 'กรุณาระบุขอบเขตแผนที่'
+        }), 400
+    if not (-90 <= south < north <= 90 and -180 <= west < east <= 180 and 0 <= zoom <= CLUSTER_MAX_ZOOM):
+        return jsonify({
+            'status': 'error',
+            'message': 'ขอบเขตแผนที่ไม่ถูกต้อง'
+        }), 400
+
+    try:
+        place_type, language = search_filter_args()
+    except ValueError:
+        return invalid_filter_response()
+
+    clusters = cluster_viewport(south, west, north, east, zoom, place_type, language)
+    if clusters is None:
+        return jsonify({
+            'status': 'error',
+            'message': 'พื้นที่กว้างเกินไป กรุณาซูมเข้า'
+        }), 400
+
+    return jsonify({
+        'status': 'success',
+        'zoom': zoom,
+        'count': sum(cluster['count'] for cluster in clusters),
+        'clusters': clusters
+    })
+
+def search_filter_args():
+    """(place_type, language) of a search request; raises ValueError if either is not accepted
+
+    Both end up in index tags and Places calls, so only the allowlisted
+    values are taken: arbitrary ones would exhaust the index's tags and
+    each cost an upstream call.
+    """
+    place_type = request.args.get('type', 'restaurant')
+    language = request.args.get('language', 'th')
+    if place_type not in SEARCH_PLACE_TYPES or language not in SEARCH_LANGUAGES:
+        raise ValueError('unsupported type or language')
+    return place_type, language
+
+def invalid_filter_response():
+    return jsonify({
+        'status': 'error',
+        'message': 'ประเภทร้านหรือภาษาไม่ถูกต้อง'
+    }), 400
+
+def name_search_args():
+    """(query, lat, lon, radius) of a name search request; raises ValueError if malformed"""
+    query = request.args.get('q', '').strip()
+    lat = request.args.get('lat', type=float)
+    lon = request.args.get('lon', type=float)
+    if (lat is None) != (lon is None) or (lat is not None and not (-90 <= lat <= 90 and -180 <= lon <= 180)):
+        raise ValueError('invalid position')
+    radius = None
+    if lat is not None:
+        radius = max(1, min(request.args.get('radius', NAME_SEARCH_RADIUS, type=int), NAME_SEARCH_RADIUS))
+    return query, lat, lon, radius
+
+@app.route('/search_restaurants')
+def search_restaurants_by_name():
+    """Restaurants matching a name, near the user when lat/lon are given"""
+    try:
+        query, lat, lon, radius = name_search_args()
+    except ValueError:
+        return jsonify({
+            'status': 'error',
+            'message': 'พิกัดไม่ถูกต้อง'
+        }), 400
+    limit = max(1, min(request.args.get('limit', 20, type=int), NAME_SEARCH_MAX_RESULTS))
+
+    restaurants = search_names(query, lat, lon, radius, limit)
+    return cached_json({
+        'status': 'success',
+        'query': query,
+        'restaurants': restaurants
+    }, NAME_SEARCH_HTTP_MAX_AGE, NAME_SEARCH_HTTP_MAX_AGE, shared=lat is None)
+
+@app.route('/autocomplete')
+def autocomplete():
+    """Name suggestions for a partially typed query, sent on every keystroke"""
+    try:
+        query, lat, lon, radius = name_search_args()
+    except ValueError:
+        return jsonify({
+            'status': 'error',
+            'message': 'พิกัดไม่ถูกต้อง'
+        }), 400
+
+    suggestions = [{key: restaurant[key] for key in ('place_id', 'name', 'vicinity', 'lat', 'lng', 'distance')
+                    if key in restaurant}
+                   for restaurant in search_names(query, lat, lon, radius, AUTOCOMPLETE_RESULTS)]
+    return cached_json({
+        'status': 'success',
+        'query': query,
+        'suggestions': suggestions
+    }, NAME_SEARCH_HTTP_MAX_AGE, NAME_SEARCH_HTTP_MAX_AGE, shared=lat is None)
+
+@app.cli.command('compact-cache')
+def compact_cache_command():
+    """Compact the shared on-disk cache"""
+    print(json.dumps(shared_cache.compact()))
+
+@app.cli.command('quota')
+def quota_command():
+    """Show the remaining Places budget for this minute and day, and the mode it puts searches in"""
+    print(json.dumps(places_quota.stats(), indent=2))
+
+@app.cli.command('import-osm')
+@click.argument('extract')
+@click.option('--output', default=LOCAL_DATASET_FILE, show_default=True, help='Dataset path to publish')
+def import_osm_command(extract, output):
+    """Import restaurants from an OSM extract (.osm[.bz2], .osm.pbf or Overpass JSON)"""
+    generation, rows = import_extract(extract, output)
+    print(f"Published generation {generation} of {output} with {rows} restaurants")
+
+@app.cli.command('update-osm')
+@click.argument('changes', nargs=-1, required=True)
+@click.option('--output', default=LOCAL_DATASET_FILE, show_default=True, help='Dataset path to update')
+def update_osm_command(changes, output):
+    """Apply OSM diffs (.osc[.gz]) to the dataset as a new generation, without stopping workers"""
+    generation, stats = update_dataset(output, list(changes))
+    print(f"Published generation {generation} of {output}: {json.dumps(stats)}")
+
+@app.cli.command('startup-report')
+def startup_report_command():
+    """Show app boot time and the import cost of each lazily loaded module"""
+    print(f"app module loaded in {STARTUP_SECONDS * 1000:.1f} ms")
+    preload(HEAVY_MODULES)
+    for name, seconds in import_report():
+        print(f"{seconds * 1000:8.1f} ms  {name}")
+
 @app.route('/test')
 def test():
     return render_template('test.html')
@@ -448,5 +1620,9 @@ def test_email():
             'message': str(e)
         }), 500
 
+STARTUP_SECONDS = time.perf_counter() - _startup_started
+logger.info(f"App module loaded in {STARTUP_SECONDS * 1000:.1f} ms")
+
 if __name__ == '__main__':
+    start_worker_tasks()
     app.run(debug=True) 
\ No newline at end of file
@@ -0,0 +1,155 @@
+import json
+import logging
+import math
+
+from lazy_imports import lazy_module
+
+np = lazy_module('numpy')
+logger = logging.getLogger(__name__)
+
+# Thai administrative levels from the smallest to the largest unit
+LEVELS = ('subdistrict', 'district', 'province')
+
+# Rings with fewer vertices than this are tested in plain Python, which beats NumPy's call overhead
+VECTORIZE_MIN_VERTICES = 64
+
+
+def _ring_crossings(ring, lon, lat):
+    """Number of ring edges crossed by a ray cast east from the point"""
+    if isinstance(ring, np.ndarray):
+        xs, ys = ring[:, 0], ring[:, 1]
+        xs_next, ys_next = np.roll(xs, -1), np.roll(ys, -1)
+        straddles = (ys > lat) != (ys_next > lat)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            crossing_x = xs + (lat - ys) * (xs_next - xs) / (ys_next - ys)
+        return int(np.count_nonzero(straddles & (lon < crossing_x)))
+
+    crossings = 0
+    x1, y1 = ring[-1]
+    for x2, y2 in ring:
+        if (y1 > lat) != (y2 > lat) and lon < x1 + (lat - y1) * (x2 - x1) / (y2 - y1):
+            crossings += 1
+        x1, y1 = x2, y2
+    return crossings
+
+
+class _Polygon:
+    """One polygon (outer ring plus holes) of an administrative area"""
+
+    __slots__ = ('feature', 'rings', 'bbox')
+
+    def __init__(self, feature, rings):
+        self.feature = feature
+        self.rings = []
+        for ring in rings:
+            points = [(float(x), float(y)) for x, y, *_ in ring]
+            self.rings.append(np.array(points) if len(points) >= VECTORIZE_MIN_VERTICES else points)
+
+        outer = [(float(x), float(y)) for x, y, *_ in rings[0]]
+        self.bbox = (min(x for x, _ in outer), min(y for _, y in outer),
+                     max(x for x, _ in outer), max(y for _, y in outer))
+
+    def contains(self, lon, lat):
+        """Even-odd ray casting over every ring, so holes are excluded"""
+        crossings = sum(_ring_crossings(ring, lon, lat) for ring in self.rings)
+        return crossings % 2 == 1
+
+
+class BoundaryIndex:
+    """Offline reverse geocoder over Thai province/district/subdistrict polygons
+
+    Loads a GeoJSON FeatureCollection once. Each feature needs a `level`
+    property (one of LEVELS) and `name_th` / `name_en` names. Polygon bounding
+    boxes are bucketed on a coarse grid; a lookup checks only the bounding
+    boxes in the point's bucket and refines the hits with point-in-polygon.
+    """
+
+    def __init__(self, cell_size=0.1):
+        self.cell_size = cell_size
+        self._polygons = []
+        self._bboxes = None  # (n, 4) array of min_lon, min_lat, max_lon, max_lat
+        self._buckets = {}
+
+    def __len__(self):
+        return len(self._polygons)
+
+    @classmethod
+    def from_file(cls, path, cell_size=0.1):
+        with open(path, 'r', encoding='utf-8') as f:
+            collection = json.load(f)
+        index = cls(cell_size=cell_size)
+        index.load(collection)
+        return index
+
+    def load(self, collection):
+        """Index the features of a GeoJSON FeatureCollection"""
+        bboxes = []
+        for feature in collection.get('features', []):
+            properties = feature.get('properties') or {}
+            if properties.get('level') not in LEVELS:
+                continue
+
+            geometry = feature.get('geometry') or {}
+            if geometry.get('type') == 'Polygon':
+                polygons = [geometry['coordinates']]
+            elif geometry.get('type') == 'MultiPolygon':
+                polygons = geometry['coordinates']
+            else:
+                continue
+
+            area = {
+                'level': properties['level'],
+                'name_th': properties.get('name_th'),
+                'name_en': properties.get('name_en'),
+                'code': properties.get('code')
+            }
+            for rings in polygons:
+                polygon = _Polygon(area, rings)
+                bboxes.append(polygon.bbox)
+                self._polygons.append(polygon)
+
+        self._bboxes = np.array(bboxes, dtype=np.float64).reshape(-1, 4)
+        self._buckets = {}
+        for i, (min_lon, min_lat, max_lon, max_lat) in enumerate(self._bboxes.tolist()):
+            for by in range(self._cell(min_lat), self._cell(max_lat) + 1):
+                for bx in range(self._cell(min_lon), self._cell(max_lon) + 1):
+                    self._buckets.setdefault((by, bx), []).append(i)
+        for key, ids in self._buckets.items():
+            self._buckets[key] = np.array(ids, dtype=np.int64)
+
+        logger.info(f"Loaded {len(self._polygons)} boundary polygons into {len(self._buckets)} buckets")
+
+    def _cell(self, value):
+        return int(math.floor(value / self.cell_size))
+
+    def lookup(self, lat, lon):
+        """Return {level: area} for every level containing the point, or None outside all areas"""
+        candidates = self._buckets.get((self._cell(lat), self._cell(lon)))
+        if candidates is None:
+            return None
+
+        boxes = self._bboxes[candidates]
+        hits = candidates[(boxes[:, 0] <= lon) & (lon <= boxes[:, 2]) &
+                          (boxes[:, 1] <= lat) & (lat <= boxes[:, 3])]
+
+        areas = {}
+        for i in hits.tolist():
+            polygon = self._polygons[i]
+            if polygon.feature['level'] not in areas and polygon.contains(lon, lat):
+                areas[polygon.feature['level']] = polygon.feature
+        return areas or None
+
+    def address(self, lat, lon, language=None):
+        """Format the areas containing a point as an address, smallest unit first"""
+        areas = self.lookup(lat, lon)
+        if not areas:
+            return None
+
+        name_key = 'name_th' if language in (None, 'th') else 'name_en'
+        names = []
+        for level in LEVELS:
+            area = areas.get(level)
+            if area:
+                names.append(area.get(name_key) or area.get('name_th') or area.get('name_en'))
+        names.append('ประเทศไทย' if name_key == 'name_th' else 'Thailand')
+        return ', '.join(name for name in names if name)
@@ -0,0 +1,132 @@
+import logging
+import time
+from collections import deque
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """The circuit is open, so the call was not attempted"""
+
+
+class CircuitBreaker:
+    """Fails calls fast while an upstream keeps erroring or stalling
+
+    Outcomes of the calls made in the last `window` seconds are kept. Once at
+    least min_calls were made and the share of failures (errors accepted by
+    is_failure, or calls slower than slow_call_seconds) reaches failure_ratio,
+    the circuit opens and calls raise CircuitOpenError for open_seconds.
+    After that it is half-open: up to half_open_probes calls go through, the
+    first success closes the circuit and a failure opens it again.
+
+    Errors accepted by not_attempted mean fn gave up before reaching the
+    upstream (e.g. a budget check refused it); they count as neither a
+    success nor a failure.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_ratio=0.5, min_calls=5, window=60, slow_call_seconds=5,
+                 open_seconds=30, half_open_probes=1, is_failure=None, not_attempted=None):
+        self.name = name
+        self.failure_ratio = failure_ratio
+        self.min_calls = min_calls
+        self.window = window
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self.is_failure = is_failure or (lambda error: True)
+        self.not_attempted = not_attempted or (lambda error: False)
+        self._state = self.CLOSED
+        self._opened_at = 0
+        self._probes = 0
+        self._outcomes = deque()  # (finished_at, failed)
+        self._lock = Lock()
+        self.rejected = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state(time.monotonic())
+
+    def _current_state(self, now):
+        if self._state == self.OPEN and now - self._opened_at >= self.open_seconds:
+            self._state = self.HALF_OPEN
+            self._probes = 0
+            logger.info(f"Circuit {self.name} half-open, probing upstream")
+        return self._state
+
+    def call(self, fn, *args, **kwargs):
+        """Call fn through the breaker; raises CircuitOpenError instead of calling while open"""
+        self._before_call()
+        started = time.monotonic()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            if self.not_attempted(e):
+                self._release()
+            else:
+                self._record(self.is_failure(e), started)
+            raise
+        self._record(time.monotonic() - started > self.slow_call_seconds, started)
+        return result
+
+    def _before_call(self):
+        with self._lock:
+            state = self._current_state(time.monotonic())
+            if state == self.CLOSED:
+                return
+            if state == self.HALF_OPEN and self._probes < self.half_open_probes:
+                self._probes += 1
+                return
+            self.rejected += 1
+        raise CircuitOpenError(f"Circuit {self.name} is open")
+
+    def _release(self):
+        """Give back the probe slot of a call that never reached the upstream"""
+        with self._lock:
+            if self._current_state(time.monotonic()) == self.HALF_OPEN:
+                self._probes = max(self._probes - 1, 0)
+
+    def _record(self, failed, started):
+        now = time.monotonic()
+        with self._lock:
+            state = self._current_state(now)
+            if state == self.HALF_OPEN:
+                self._probes = max(self._probes - 1, 0)
+                if failed:
+                    self._open(now, f"probe failed after {now - started:.1f}s")
+                else:
+                    self._state = self.CLOSED
+                    self._outcomes.clear()
+                    logger.info(f"Circuit {self.name} closed, upstream recovered")
+                return
+            if state == self.OPEN:
+                # A call started before the circuit opened; its outcome is no longer needed
+                return
+
+            self._outcomes.append((now, failed))
+            while self._outcomes and self._outcomes[0][0] < now - self.window:
+                self._outcomes.popleft()
+            failures = sum(1 for _, outcome in self._outcomes if outcome)
+            if len(self._outcomes) >= self.min_calls and failures >= self.failure_ratio * len(self._outcomes):
+                self._open(now, f"{failures}/{len(self._outcomes)} calls failed or were slow")
+
+    def _open(self, now, reason):
+        self._state = self.OPEN
+        self._opened_at = now
+        self._outcomes.clear()
+        logger.warning(f"Circuit {self.name} opened for {self.open_seconds}s: {reason}")
+
+    def stats(self):
+        with self._lock:
+            state = self._current_state(time.monotonic())
+            return {
+                'state': state,
+                'recent_calls': len(self._outcomes),
+                'recent_failures': sum(1 for _, failed in self._outcomes if failed),
+                'rejected': self.rejected
+            }
@@ -0,0 +1,72 @@
+import math
+
+from lazy_imports import lazy_module
+
+np = lazy_module('numpy')
+
+TILE_SIZE = 256  # pixels of a web map tile
+MAX_LATITUDE = 85.05112878  # web mercator cuts off the poles here
+
+
+def mercator_pixels(lats, lons, zoom):
+    """Web mercator pixel coordinates (x, y) of points at a zoom level"""
+    scale = TILE_SIZE * (1 << zoom)
+    lats = np.clip(np.asarray(lats, dtype=np.float64), -MAX_LATITUDE, MAX_LATITUDE)
+    lons = np.asarray(lons, dtype=np.float64)
+    x = (lons + 180.0) / 360.0 * scale
+    phi = np.radians(lats)
+    y = (1.0 - np.log(np.tan(phi) + 1.0 / np.cos(phi)) / math.pi) / 2.0 * scale
+    return x, y
+
+
+def grid_aggregate(lats, lons, items, zoom, cell_px=60):
+    """Group points into square grid cells of cell_px screen pixels at a zoom level
+
+    Returns {(gx, gy): [count, sum_lat, sum_lng, item]} where item is the single
+    member of a one-point cell and None otherwise. The grid is global, so
+    aggregates of neighbouring areas can be combined with merge_aggregates().
+    """
+    if not len(lats):
+        return {}
+    x, y = mercator_pixels(lats, lons, zoom)
+    gx = np.floor(x / cell_px).astype(np.int64)
+    gy = np.floor(y / cell_px).astype(np.int64)
+    keys, first, inverse, counts = np.unique(np.stack([gx, gy], axis=1), axis=0,
+                                             return_index=True, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+    sum_lats = np.bincount(inverse, weights=np.asarray(lats, dtype=np.float64), minlength=len(keys))
+    sum_lons = np.bincount(inverse, weights=np.asarray(lons, dtype=np.float64), minlength=len(keys))
+
+    aggregates = {}
+    for (key_x, key_y), index, count, sum_lat, sum_lng in zip(keys.tolist(), first.tolist(), counts.tolist(),
+                                                              sum_lats.tolist(), sum_lons.tolist()):
+        aggregates[(key_x, key_y)] = [count, sum_lat, sum_lng, items[index] if count == 1 else None]
+    return aggregates
+
+
+def merge_aggregates(parts):
+    """Combine grid aggregates of several areas into a list of clusters
+
+    Each cluster has its member count and centroid; a cluster of one also
+    carries the restaurant itself.
+    """
+    merged = {}
+    for aggregates in parts:
+        for key, (count, sum_lat, sum_lng, item) in aggregates.items():
+            total = merged.get(key)
+            if total is None:
+                merged[key] = [count, sum_lat, sum_lng, item]
+            else:
+                total[0] += count
+                total[1] += sum_lat
+                total[2] += sum_lng
+                total[3] = None
+
+    clusters = []
+    for count, sum_lat, sum_lng, item in merged.values():
+        cluster = {'count': count, 'lat': sum_lat / count, 'lng': sum_lng / count}
+        if count == 1:
+            cluster['restaurant'] = item
+        clusters.append(cluster)
+    clusters.sort(key=lambda cluster: cluster['count'], reverse=True)
+    return clusters
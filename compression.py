@@ -0,0 +1,88 @@
+import gzip
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # optional, gzip is always available
+    brotli = None
+
+# Preferred first when the client accepts several with the same quality
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+COMPRESSIBLE_MIMETYPES = {'application/json', 'text/html', 'text/plain', 'text/css', 'application/javascript'}
+
+
+def compress(data, encoding, best=False):
+    """Compress bytes with the given content coding
+
+    best=True spends more CPU for a smaller payload, meant for content that
+    is compressed once and served many times.
+    """
+    if encoding == 'br':
+        return brotli.compress(data, quality=11 if best else 5)
+    if encoding == 'gzip':
+        # mtime=0 keeps the output deterministic for identical input
+        return gzip.compress(data, compresslevel=9 if best else 6, mtime=0)
+    raise ValueError(f"Unsupported content coding: {encoding}")
+
+
+def precompress(data):
+    """Return {encoding: body} for every supported coding plus 'identity'"""
+    variants = {'identity': data}
+    for encoding in ENCODINGS:
+        variants[encoding] = compress(data, encoding, best=True)
+    return variants
+
+
+def negotiate(accept_encodings, available=ENCODINGS):
+    """Pick the content coding for a request's Accept-Encoding, or 'identity'
+
+    accept_encodings is werkzeug's parsed request.accept_encodings, so q-values
+    (including q=0 refusals) are honored.
+    """
+    best = accept_encodings.best_match(available)
+    return best or 'identity'
+
+
+class Compressor:
+    """Compresses eligible responses of a Flask app on the fly
+
+    Only successful, non-streamed responses of a compressible type that are
+    at least min_size bytes are compressed. Responses that already carry a
+    Content-Encoding (e.g. precompressed ones) are left alone.
+    """
+
+    def __init__(self, app=None, min_size=1024):
+        self.min_size = min_size
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.after_request(self.after_request)
+
+    def after_request(self, response):
+        if (response.status_code != 200
+                or response.direct_passthrough
+                or response.is_streamed
+                or 'Content-Encoding' in response.headers
+                or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+            return response
+
+        response.vary.add('Accept-Encoding')
+        data = response.get_data()
+        if len(data) < self.min_size:
+            return response
+
+        encoding = negotiate(request.accept_encodings)
+        if encoding == 'identity':
+            return response
+
+        response.set_data(compress(data, encoding))
+        response.headers['Content-Encoding'] = encoding
+        # A compressed body is a different representation, so a strong validator must
+        # change with it; weak ones already only promise equivalent content
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(f"{etag}-{encoding}")
+        return response
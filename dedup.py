@@ -0,0 +1,325 @@
+import math
+import re
+import unicodedata
+from functools import lru_cache
+
+from lazy_imports import lazy_module
+from spatial_index import METERS_PER_DEGREE
+
+np = lazy_module('numpy')
+
+# Source of results that do not say where they came from (Google Places)
+DEFAULT_SOURCE = 'google'
+
+# Placeholders the sources use for missing fields; never worth keeping over a real value
+PLACEHOLDERS = frozenset(('ไม่ระบุชื่อ', 'ไม่ระบุที่อยู่'))
+
+# Generic words that say what a place is rather than which one it is. The Latin ones are
+# whole words only, but Thai is written without spaces, so a Thai letter next to one counts
+# as a word boundary too (\b would not match between "ร้าน" and "cafe")
+GENERIC_WORDS = re.compile(
+    r'ร้านอาหาร|ร้าน|ภัตตาคาร|คาเฟ่|กาแฟ|สาขา|'
+    r'(?<![a-z0-9])(?:restaurant|cafe|café|coffee|shop|the|branch|bar|kitchen)(?![a-z0-9])'
+)
+# Thai vowel and tone marks are not \w to the re module, so the Thai block is listed explicitly
+NON_WORD = re.compile(r'[^\w\u0e00-\u0e7f]+|_+')
+
+# A block and the eight around it
+NEIGHBOUR_OFFSETS = tuple((dy, dx) for dy in (-1, 0, 1) for dx in (-1, 0, 1))
+
+
+def fold(name):
+    """Lowercased, compatibility-normalized name without Latin accents"""
+    name = unicodedata.normalize('NFKC', name).lower()
+    # Drop Latin accents, but not Thai vowels and tone marks, which are combining characters too
+    return ''.join(char for char in unicodedata.normalize('NFKD', name)
+                   if not unicodedata.combining(char) or '\u0e00' <= char <= '\u0e7f')
+
+
+@lru_cache(maxsize=65536)
+def normalize_name(name):
+    """Lowercased name without accents, punctuation, spacing or generic words"""
+    if not name or name in PLACEHOLDERS:
+        return ''
+    name = fold(name)
+    stripped = NON_WORD.sub('', GENERIC_WORDS.sub(' ', name))
+    # A name made of generic words only ("ร้านกาแฟ") still identifies something
+    return stripped or NON_WORD.sub('', name)
+
+
+@lru_cache(maxsize=65536)
+def _bigrams(name):
+    return frozenset(name[i:i + 2] for i in range(len(name) - 1)) or frozenset((name,))
+
+
+@lru_cache(maxsize=65536)
+def _bigram_hashes(name):
+    return tuple(hash(gram) for gram in _bigrams(name))
+
+
+def _name_keys(restaurant):
+    """Normalized name variants (e.g. Thai and English) of a candidate"""
+    names = {normalize_name(restaurant.get('name')), normalize_name(restaurant.get('name_en'))}
+    names.discard('')
+    return names
+
+
+def name_similarity(names_a, names_b):
+    """Best Dice coefficient of character bigrams over all pairs of normalized name variants"""
+    best = 0.0
+    for a in names_a:
+        for b in names_b:
+            if a == b:
+                return 1.0
+            if len(a) >= 3 and len(b) >= 3 and (a in b or b in a):
+                # "somtam" vs "somtamnua": one name abbreviates the other
+                best = max(best, 0.9)
+                continue
+            grams_a, grams_b = _bigrams(a), _bigrams(b)
+            best = max(best, 2 * len(grams_a & grams_b) / (len(grams_a) + len(grams_b)))
+    return best
+
+
+def _expand(starts, counts):
+    """Positions starts[k] .. starts[k] + counts[k] - 1 for every k, and the k each belongs to"""
+    owners = np.repeat(np.arange(len(counts)), counts)
+    return np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(len(owners)), owners
+
+
+def similar_pairs(candidates, first, second, min_similarity):
+    """Mask of the candidate pairs (first[k], second[k]) whose names are min_similarity alike
+
+    Scores every pair like name_similarity(), but in NumPy: each distinct
+    name variant gets its bigrams as dense ids, and the bigrams two
+    variants share are counted by sorting (pair, bigram) keys, so the cost
+    per pair is a few array operations rather than Python set arithmetic.
+    Only the few pairs whose bigrams are a subset of the other's are checked
+    for containment in Python.
+    """
+    matched = np.zeros(len(first), dtype=bool)
+    if not len(first):
+        return matched
+
+    # Name variants of every candidate in a pair, each distinct name once
+    variant_ids, variants, gram_hashes, gram_counts = {}, [], [], []
+    paired = np.unique(np.concatenate((first, second)))
+    owned, owned_counts = [], []
+    for i in paired.tolist():
+        names = _name_keys(candidates[i])
+        for name in names:
+            variant = variant_ids.get(name)
+            if variant is None:
+                variant = variant_ids[name] = len(variants)
+                variants.append(name)
+                hashes = _bigram_hashes(name)
+                gram_hashes.extend(hashes)
+                gram_counts.append(len(hashes))
+            owned.append(variant)
+        owned_counts.append(len(names))
+    counts = np.zeros(len(candidates), dtype=np.int64)
+    counts[paired] = owned_counts
+    starts = np.zeros(len(candidates), dtype=np.int64)
+    starts[paired] = np.cumsum(counts[paired]) - counts[paired]
+    owned = np.array(owned, dtype=np.int64)
+    if not len(owned):
+        return matched
+    gram_counts = np.array(gram_counts, dtype=np.int64)
+    gram_starts = np.cumsum(gram_counts) - gram_counts
+    # Dense bigram ids, numbered in hash order
+    gram_hashes = np.array(gram_hashes, dtype=np.int64)
+    order = np.argsort(gram_hashes)
+    sorted_hashes = gram_hashes[order]
+    grams = np.empty(len(order), dtype=np.int64)
+    grams[order] = np.cumsum(np.concatenate(([0], sorted_hashes[1:] != sorted_hashes[:-1])))
+    gram_space = int(grams.max()) + 1
+    # Each variant's bigrams in ascending order, so the keys below come in two ascending runs
+    grams = np.sort(np.repeat(np.arange(len(variants)), gram_counts) * gram_space + grams) % gram_space
+
+    # Every pairing of a variant of first[k] with one of second[k]
+    pairings = counts[first] * counts[second]
+    offsets, pair_of = _expand(np.zeros(len(first), dtype=np.int64), pairings)
+    per_second = counts[second][pair_of]
+    variant_a = owned[starts[first][pair_of] + offsets // per_second]
+    variant_b = owned[starts[second][pair_of] + offsets % per_second]
+
+    # Shared bigrams: the (pairing, bigram) keys that occur for both variants
+    positions_a, pairing_a = _expand(gram_starts[variant_a], gram_counts[variant_a])
+    positions_b, pairing_b = _expand(gram_starts[variant_b], gram_counts[variant_b])
+    keys = np.sort(np.concatenate((pairing_a * gram_space + grams[positions_a],
+                                   pairing_b * gram_space + grams[positions_b])), kind='stable')
+    shared = np.bincount(keys[1:][keys[1:] == keys[:-1]] // gram_space, minlength=len(variant_a))
+
+    count_a, count_b = gram_counts[variant_a], gram_counts[variant_b]
+    score = 2 * shared / (count_a + count_b)
+    lengths = np.fromiter(map(len, variants), dtype=np.int64, count=len(variants))
+    maybe_contained = np.flatnonzero((variant_a != variant_b) & (lengths[variant_a] >= 3) & (lengths[variant_b] >= 3)
+                                     & (shared == np.minimum(count_a, count_b)))
+    for k in maybe_contained.tolist():
+        a, b = variants[variant_a[k]], variants[variant_b[k]]
+        if a in b or b in a:
+            # "somtam" vs "somtamnua": one name abbreviates the other
+            score[k] = 0.9
+    score[variant_a == variant_b] = 1.0
+    matched[pair_of[score >= min_similarity]] = True
+    return matched
+
+
+def candidate_pairs(lats, lons, sources, max_distance):
+    """(i, j, meters) of candidates from different sources at most max_distance apart
+
+    Candidates are bucketed into blocks at least max_distance wide, so only
+    candidates in the same or adjacent blocks are measured. Pairs are
+    looked up from the candidates outside the most common source only
+    (e.g. 60 Places results among thousands of dataset rows), so the work
+    grows with those few times the block density rather than with every
+    candidate's neighbours.
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    empty = np.empty(0, dtype=np.int64)
+    _, codes, counts = np.unique(np.asarray(sources), return_inverse=True, return_counts=True)
+    codes = codes.reshape(-1)
+    if len(counts) < 2:
+        return empty, empty, np.empty(0, dtype=np.float64)
+    common = int(np.argmax(counts))
+    anchors = np.flatnonzero(codes != common)
+
+    lat_size = max_distance / METERS_PER_DEGREE
+    lon_scale = max(math.cos(math.radians(min(float(np.abs(lats).max()), 89.0))), 0.01)
+    lon_size = lat_size / lon_scale
+    block_y = np.floor(lats / lat_size).astype(np.int64)
+    block_x = np.floor(lons / lon_size).astype(np.int64)
+    width = int(block_x.max() - block_x.min()) + 3
+    keys = (block_y - block_y.min() + 1) * width + (block_x - block_x.min() + 1)
+
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+
+    firsts, seconds = [], []
+    for dy, dx in NEIGHBOUR_OFFSETS:
+        target = keys[anchors] + dy * width + dx
+        lows = np.searchsorted(sorted_keys, target, side='left')
+        highs = np.searchsorted(sorted_keys, target, side='right')
+        counts = highs - lows
+        left = np.repeat(anchors, counts)
+        right = np.repeat(lows, counts) + (np.arange(len(left)) - np.repeat(np.cumsum(counts) - counts, counts))
+        firsts.append(left)
+        seconds.append(order[right])
+
+    first = np.concatenate(firsts)
+    second = np.concatenate(seconds)
+    # Two anchors of different sources find each other twice; keep one of the two
+    keep = (codes[first] != codes[second]) & ((codes[second] == common) | (first < second))
+    first, second = first[keep], second[keep]
+
+    # Equirectangular distance is plenty accurate over a few dozen meters
+    dy = (lats[second] - lats[first]) * METERS_PER_DEGREE
+    dx = (lons[second] - lons[first]) * METERS_PER_DEGREE * np.cos(np.radians((lats[first] + lats[second]) / 2))
+    distances = np.hypot(dx, dy)
+    close = distances <= max_distance
+    return first[close], second[close], distances[close]
+
+
+def _find(parents, i):
+    while parents[i] != i:
+        parents[i] = parents[parents[i]]
+        i = parents[i]
+    return i
+
+
+def _richer(values):
+    """The most informative of several values of one field"""
+    real = [value for value in values if value not in (None, '') and value not in PLACEHOLDERS]
+    if not real:
+        return values[0]
+    if isinstance(real[0], str):
+        return max(real, key=len)
+    return real[0]
+
+
+def merge_group(group):
+    """One restaurant from duplicates of it, keeping the richest field of each source
+
+    group is ordered by source preference: its first member supplies the
+    identity (place_id, name, position) unless it lacks them. Ratings come
+    from whichever source has the most reviews behind them.
+    """
+    merged = dict(group[0])
+    for field in ('name', 'name_en', 'cuisine'):
+        values = [member.get(field) for member in group]
+        value = values[0] if values[0] not in (None, '') and values[0] not in PLACEHOLDERS else _richer(values)
+        if value is not None:
+            merged[field] = value
+    merged['vicinity'] = _richer([member.get('vicinity') for member in group])
+
+    rated = max(group, key=lambda member: member.get('user_ratings_total') or 0)
+    merged['rating'] = rated.get('rating')
+    merged['user_ratings_total'] = rated.get('user_ratings_total')
+    if 'distance' in merged:
+        merged['distance'] = min(member['distance'] for member in group if 'distance' in member)
+    merged['sources'] = sorted({member.get('source', DEFAULT_SOURCE) for member in group})
+    # Other sources' ids, so clients can link out to them
+    merged['duplicate_ids'] = [member['place_id'] for member in group[1:] if member.get('place_id')]
+    return merged
+
+
+def merge_candidates(candidates, max_distance=60.0, min_similarity=0.5):
+    """Deduplicate restaurants gathered from several sources
+
+    Two candidates from different sources are the same place when they lie
+    within max_distance meters and their normalized names (any variant,
+    e.g. Thai or English) are at least min_similarity alike; candidates
+    with the same place_id always are. Duplicates are merged with
+    merge_group(), earlier candidates taking precedence. Candidates from one
+    source are never merged with each other. Returns the merged list in the
+    order of each group's first candidate.
+
+    Blocking and name scoring are vectorized, but reading and merging the
+    candidate dicts is not, so the cost stays about linear in the
+    candidates: ~3ms for 60 Places results among 2k dataset rows, ~25ms
+    among 30k.
+    """
+    if len(candidates) < 2:
+        return list(candidates)
+
+    parents = list(range(len(candidates)))
+    involved = set()
+
+    def union(i, j):
+        root_i, root_j = _find(parents, i), _find(parents, j)
+        if root_i != root_j:
+            # The earlier candidate stays the root so its source keeps precedence
+            parents[max(root_i, root_j)] = min(root_i, root_j)
+            involved.update((i, j))
+
+    place_ids = [candidate.get('place_id') for candidate in candidates]
+    # Usually every id is distinct and there is nothing to union
+    if len(set(place_ids)) < len(place_ids):
+        first_with_id = {}
+        for i, place_id in enumerate(place_ids):
+            if place_id is not None:
+                j = first_with_id.setdefault(place_id, i)
+                if j != i:
+                    union(i, j)
+
+    sources = [candidate.get('source', DEFAULT_SOURCE) for candidate in candidates]
+    if len(set(sources)) > 1:
+        first, second, _ = candidate_pairs([candidate['lat'] for candidate in candidates],
+                                           [candidate['lng'] for candidate in candidates],
+                                           sources, max_distance)
+        matched = similar_pairs(candidates, first, second, min_similarity)
+        for i, j in zip(first[matched].tolist(), second[matched].tolist()):
+            union(i, j)
+
+    if not involved:
+        return list(candidates)
+    # Only the few candidates that were matched need regrouping
+    groups = {}
+    for i in sorted(involved):
+        groups.setdefault(_find(parents, i), []).append(i)
+    merged = list(candidates)
+    for root, members in groups.items():
+        merged[root] = merge_group([candidates[i] for i in members])
+        for i in members[1:]:
+            merged[i] = None
+    return [candidate for candidate in merged if candidate is not None]
@@ -0,0 +1,125 @@
+import math
+
+EARTH_RADIUS = 6371000  # Earth radius in meters
+
+_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+_BASE32_INDEX = {c: i for i, c in enumerate(_BASE32)}
+
+
+def calculate_distance(lat1, lon1, lat2, lon2):
+    """Calculate distance between two points using Haversine formula"""
+    R = EARTH_RADIUS
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    delta_phi = math.radians(lat2 - lat1)
+    delta_lambda = math.radians(lon2 - lon1)
+
+    a = math.sin(delta_phi/2)**2 + math.cos(phi1) * math.cos(phi2) * math.sin(delta_lambda/2)**2
+    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
+    return R * c
+
+
+def geohash_encode(lat, lon, precision=6):
+    """Encode a coordinate into a geohash string of the given length"""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True
+
+    while len(chars) < precision:
+        rng, value = (lon_range, lon) if even else (lat_range, lat)
+        mid = (rng[0] + rng[1]) / 2
+        if value >= mid:
+            bits = (bits << 1) | 1
+            rng[0] = mid
+        else:
+            bits = bits << 1
+            rng[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(_BASE32[bits])
+            bits = 0
+            bit_count = 0
+
+    return ''.join(chars)
+
+
+def is_geohash(value, precision=None):
+    """True if value is a geohash string, optionally of exactly the given length"""
+    if not value or (precision is not None and len(value) != precision):
+        return False
+    return all(char in _BASE32_INDEX for char in value)
+
+
+def geohash_to_int(cell):
+    """The bits of a geohash as an integer (5 bits per character)"""
+    value = 0
+    for char in cell:
+        value = (value << 5) | _BASE32_INDEX[char]
+    return value
+
+
+def geohash_bounds(cell):
+    """Return (south, west, north, east) of a geohash cell"""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    even = True
+
+    for char in cell:
+        value = _BASE32_INDEX[char]
+        for shift in range(4, -1, -1):
+            rng = lon_range if even else lat_range
+            mid = (rng[0] + rng[1]) / 2
+            if (value >> shift) & 1:
+                rng[0] = mid
+            else:
+                rng[1] = mid
+            even = not even
+
+    return lat_range[0], lon_range[0], lat_range[1], lon_range[1]
+
+
+def geohash_center(cell):
+    """Return the (lat, lon) center of a geohash cell"""
+    south, west, north, east = geohash_bounds(cell)
+    return (south + north) / 2, (west + east) / 2
+
+
+def geohash_cell_radius(cell):
+    """Distance in meters from the center of a cell to its farthest corner"""
+    south, west, north, east = geohash_bounds(cell)
+    center_lat, center_lon = (south + north) / 2, (west + east) / 2
+    return max(calculate_distance(center_lat, center_lon, corner_lat, corner_lon)
+               for corner_lat in (south, north)
+               for corner_lon in (west, east))
+
+
+def geohash_cells_in_bbox(south, west, north, east, precision=6, max_cells=None):
+    """Geohash cells of the given length that together cover a bounding box
+
+    Returns None when more than max_cells cells would be needed.
+    """
+    lon_bits = (5 * precision + 1) // 2
+    lat_bits = 5 * precision // 2
+    cell_height = 180.0 / (1 << lat_bits)
+    cell_width = 360.0 / (1 << lon_bits)
+
+    # Snap to the grid so each row and column of cells is visited once
+    first_row = math.floor((max(south, -90.0) + 90.0) / cell_height)
+    last_row = math.floor((min(north, 90.0 - 1e-12) + 90.0) / cell_height)
+    first_col = math.floor((max(west, -180.0) + 180.0) / cell_width)
+    last_col = math.floor((min(east, 180.0 - 1e-12) + 180.0) / cell_width)
+
+    count = (last_row - first_row + 1) * (last_col - first_col + 1)
+    if max_cells is not None and count > max_cells:
+        return None
+
+    cells = []
+    for row in range(first_row, last_row + 1):
+        lat = -90.0 + (row + 0.5) * cell_height
+        for col in range(first_col, last_col + 1):
+            cells.append(geohash_encode(lat, -180.0 + (col + 0.5) * cell_width, precision))
+    return cells
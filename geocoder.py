@@ -0,0 +1,84 @@
+import logging
+import time
+from threading import Lock
+
+from lazy_imports import lazy_module
+
+aiohttp = lazy_module('aiohttp')
+logger = logging.getLogger(__name__)
+
+
+class GeocoderBusy(Exception):
+    """No rate-limit slot is free before the caller's deadline"""
+
+
+class RateLimiter:
+    """Hands out request slots at a fixed interval in arrival order
+
+    With a shared store (shared_cache.SharedCache) the slots are shared by
+    every worker on the host; otherwise they are per process.
+    """
+
+    def __init__(self, name, interval, store=None):
+        self.name = name
+        self.interval = interval
+        self.store = store
+        self._next_slot = 0
+        self._not_before = 0
+        self._lock = Lock()
+
+    def reserve(self, max_delay):
+        """Reserve the next slot; returns the delay until it, or None if beyond max_delay"""
+        if self.store is not None:
+            try:
+                return self.store.reserve_slot(self.name, self.interval, max_delay,
+                                               not_before=self._not_before)
+            except Exception as e:
+                logger.warning(f"Shared rate limiter unavailable, using local slots: {str(e)}")
+
+        with self._lock:
+            now = time.time()
+            slot = max(now, self._next_slot, self._not_before)
+            if slot - now > max_delay:
+                return None
+            self._next_slot = slot + self.interval
+            return slot - now
+
+    def back_off(self, seconds):
+        """Hand out no slots for the next `seconds`, e.g. after being throttled"""
+        with self._lock:
+            self._not_before = max(self._not_before, time.time() + seconds)
+
+
+class Geocoder:
+    """Shared, thread-safe Nominatim reverse geocoder
+
+    Requests go through the pooled keep-alive session of the upstream client
+    and are spaced by a rate limiter honoring Nominatim's usage policy. Callers
+    queue for the next free slot but never wait longer than their deadline.
+    """
+
+    def __init__(self, client, min_interval=1.0, max_wait=3.0, throttle_backoff=30, store=None):
+        self.client = client
+        self.max_wait = max_wait
+        self.throttle_backoff = throttle_backoff
+        self.limiter = RateLimiter('nominatim', min_interval, store=store)
+
+    def reverse(self, lat, lon, language=None, timeout=5, max_wait=None):
+        """Return Nominatim's result for a coordinate, or None when nothing is found
+
+        Raises GeocoderBusy if no slot frees up within max_wait seconds.
+        """
+        delay = self.limiter.reserve(self.max_wait if max_wait is None else max_wait)
+        if delay is None:
+            raise GeocoderBusy('Nominatim rate limit reached')
+        if delay > 0:
+            time.sleep(delay)
+
+        try:
+            return self.client.reverse(lat, lon, language=language, timeout=timeout)
+        except aiohttp.ClientResponseError as e:
+            if e.status == 429:
+                logger.warning(f"Throttled by Nominatim, pausing lookups for {self.throttle_backoff}s")
+                self.limiter.back_off(self.throttle_backoff)
+            raise
@@ -0,0 +1,30 @@
+import os
+
+# Threaded workers: views wait on upstream calls, so each worker serves WORKER_THREADS requests
+# at once. app.py sizes the upstream client's concurrency limit from the same setting.
+worker_class = 'gthread'
+threads = int(os.getenv('WORKER_THREADS', '32'))
+
+# Import the app once in the master and fork workers from it (GUNICORN_PRELOAD=1),
+# so the heavy modules are loaded a single time and shared copy-on-write.
+preload_app = os.getenv('GUNICORN_PRELOAD', '0').lower() in ('1', 'true', 'yes')
+
+
+def when_ready(server):
+    if not preload_app:
+        return
+
+    import app
+    from lazy_imports import import_report, preload
+
+    preload(app.HEAVY_MODULES)
+    total = sum(seconds for _, seconds in import_report())
+    server.log.info(f"Preloaded heavy modules in {total * 1000:.1f} ms")
+
+
+def post_fork(server, worker):
+    # Background threads started in a preloading master would not survive the fork,
+    # so each worker starts its own
+    import app
+
+    app.start_worker_tasks()
@@ -0,0 +1,69 @@
+import importlib
+import logging
+import sys
+import time
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+_import_times = {}
+_lock = Lock()
+
+
+def timed_import(name):
+    """Import a module, recording how long the first import took"""
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+
+    with _lock:
+        module = sys.modules.get(name)
+        if module is not None:
+            return module
+        started = time.perf_counter()
+        module = importlib.import_module(name)
+        _import_times[name] = time.perf_counter() - started
+
+    logger.debug(f"Imported {name} in {_import_times[name] * 1000:.1f} ms")
+    return module
+
+
+class LazyModule:
+    """Stand-in for a module that is only imported when an attribute is first used"""
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_module']
+        if module is None:
+            module = timed_import(self.__dict__['_name'])
+            self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = 'loaded' if self.__dict__['_module'] is not None else 'not loaded'
+        return f"<lazy module {self.__dict__['_name']!r} ({state})>"
+
+
+def lazy_module(name):
+    return LazyModule(name)
+
+
+def preload(names):
+    """Import modules now, e.g. in the gunicorn master so forked workers share them"""
+    for name in names:
+        try:
+            timed_import(name)
+        except ImportError as e:
+            logger.warning(f"Could not preload {name}: {str(e)}")
+
+
+def import_report():
+    """[(module, seconds)] for every module imported through this module, slowest first"""
+    with _lock:
+        return sorted(_import_times.items(), key=lambda item: item[1], reverse=True)
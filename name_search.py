@@ -0,0 +1,428 @@
+import math
+import time
+from array import array
+from collections import OrderedDict
+from threading import RLock
+
+from dedup import NON_WORD, PLACEHOLDERS, fold
+from lazy_imports import lazy_module
+from ranking import haversine_many
+from spatial_index import METERS_PER_DEGREE
+
+np = lazy_module('numpy')
+
+# Thai is written without spaces, so names are indexed by character trigrams
+# rather than words. A leading space marks where each word starts, which lets
+# two-character queries match as word prefixes.
+MIN_QUERY_LENGTH = 2
+
+# Score = text match, proximity and rating blended with these weights
+TEXT_WEIGHT = 0.6
+DISTANCE_WEIGHT = 0.25
+RATING_WEIGHT = 0.15
+DISTANCE_SCALE = 2000  # meters at which the proximity score falls to 1/e
+REVIEWS_SCALE = math.log1p(1000)  # review count at which a rating is fully trusted
+
+# Trigram keys pack three code points of 21 bits each
+CODE_POINT_BITS = 21
+
+# Candidates checked against the query text per result wanted, see _verified()
+VERIFY_FACTOR = 5
+
+# Queries matching more names than this rank an evenly spread sample of them,
+# which keeps very common words ("ร้าน") within the per-keystroke budget
+MAX_CANDIDATES = 10000
+
+
+def search_text(name):
+    """Folded name with words separated by single spaces, starting with a space"""
+    if not name or name in PLACEHOLDERS:
+        return ''
+    words = [word for word in NON_WORD.split(fold(name)) if word]
+    return ' ' + ' '.join(words) if words else ''
+
+
+def _code_points(text):
+    return np.frombuffer(text.encode('utf-32-le'), dtype='<u4').astype(np.uint64)
+
+
+def _pack(code_points):
+    """Trigram keys of each run of three consecutive code points"""
+    return ((code_points[:-2] << np.uint64(2 * CODE_POINT_BITS)) | (code_points[1:-1] << np.uint64(CODE_POINT_BITS))
+            | code_points[2:])
+
+
+def trigram_keys(text):
+    """Integer keys of every trigram of text, in order"""
+    code_points = _code_points(text)
+    if len(code_points) < 3:
+        return np.empty(0, dtype=np.uint64)
+    return _pack(code_points)
+
+
+def build_trigram_index(texts, rows):
+    """Inverted index of texts (from search_text) belonging to rows
+
+    Returns (keys, offsets, postings): the sorted distinct trigram keys, and
+    for key i the sorted rows postings[offsets[i]:offsets[i + 1]] whose
+    texts contain it. Built in a few vectorized passes, so millions of names
+    take seconds.
+    """
+    if not texts:
+        return np.empty(0, dtype=np.uint64), np.zeros(1, dtype=np.int64), np.empty(0, dtype=np.int64)
+    # NUL never survives search_text, so it safely separates the texts
+    code_points = _code_points('\0'.join(texts))
+    if len(code_points) < 3:
+        return np.empty(0, dtype=np.uint64), np.zeros(1, dtype=np.int64), np.empty(0, dtype=np.int64)
+    lengths = np.fromiter(map(len, texts), dtype=np.int64, count=len(texts))
+    owners = np.repeat(np.asarray(rows, dtype=np.int64), lengths + 1)[:len(code_points)]
+
+    keys = _pack(code_points)
+    valid = (code_points[:-2] != 0) & (code_points[1:-1] != 0) & (code_points[2:] != 0)
+    keys, owners = keys[valid], owners[:-2][valid]
+
+    order = np.lexsort((owners, keys))
+    keys, owners = keys[order], owners[order]
+    distinct = np.ones(len(keys), dtype=bool)
+    distinct[1:] = (keys[1:] != keys[:-1]) | (owners[1:] != owners[:-1])
+    keys, owners = keys[distinct], owners[distinct]
+
+    unique_keys, starts = np.unique(keys, return_index=True)
+    return unique_keys, np.append(starts, len(keys)).astype(np.int64), owners
+
+
+class Query:
+    """A parsed search query: its text and the trigrams a matching name must contain"""
+
+    def __init__(self, query):
+        text = search_text(query).strip()
+        self.text = text
+        self.valid = len(text) >= MIN_QUERY_LENGTH
+        if not self.valid:
+            return
+        # Names with a word starting like the query rank first
+        self.prefix_key = int(trigram_keys(' ' + text[:2])[0])
+        if len(text) < 3:
+            # Too short for a trigram of its own, so it can only match word starts
+            self.keys = [self.prefix_key]
+            self.exact = True
+        else:
+            self.keys = sorted(set(trigram_keys(text).tolist()))
+            # Trigrams found in the right order guarantee the match only when there is one
+            self.exact = len(self.keys) == 1
+        self.length = len(text.encode('utf-8'))
+
+    def matches(self, *names):
+        return any(self.text in search_text(name) for name in names)
+
+
+def match_rows(postings, keys, ranges=None, max_candidates=MAX_CANDIDATES, within=None):
+    """Rows whose postings hold every key, optionally only rows within [(start, stop)] ranges
+
+    postings(key) returns the sorted rows of a key. Starts from the rarest
+    key and probes the others by binary search, so a query costs about
+    the rarest posting list's length times log of the others'. within, in
+    any order, restricts the result to those rows (e.g. the ones near the
+    user); when it is shorter than the rarest list, matching starts from it
+    instead. At most max_candidates rows are probed, evenly strided.
+    """
+    lists = [postings(key) for key in keys]
+    if any(len(rows) == 0 for rows in lists):
+        return np.empty(0, dtype=np.int64)
+    lists.sort(key=len)
+
+    candidates = lists[0]
+    if ranges is not None:
+        # Rows are sorted, so each range is one contiguous slice of the list
+        bounds = np.searchsorted(candidates, np.array(ranges, dtype=np.int64).reshape(-1).astype(candidates.dtype))
+        candidates = np.concatenate([candidates[start:stop] for start, stop in zip(bounds[::2], bounds[1::2])]
+                                    or [candidates[:0]])
+    probed = lists[1:]
+    if within is not None:
+        within = np.asarray(within, dtype=np.int64)
+        if len(within) < len(candidates):
+            candidates, probed = within, [candidates] + probed
+        elif len(within):
+            # A mask over the row numbers spares sorting within
+            member = np.zeros(int(within.max()) + 1, dtype=bool)
+            member[within] = True
+            candidates = candidates[candidates < len(member)]
+            candidates = candidates[member[candidates]]
+        else:
+            candidates = candidates[:0]
+    if max_candidates and len(candidates) > max_candidates:
+        candidates = candidates[np.linspace(0, len(candidates) - 1, max_candidates).astype(np.int64)]
+    for rows in probed:
+        if not len(candidates):
+            break
+        candidates = candidates[contains(rows, candidates)]
+    return candidates.astype(np.int64)
+
+
+def contains(rows, candidates):
+    """Mask of candidates present in the sorted rows"""
+    if not len(rows):
+        return np.zeros(len(candidates), dtype=bool)
+    # Search in the rows' dtype; mixing dtypes would convert the whole posting list
+    candidates = np.asarray(candidates).astype(rows.dtype, copy=False)
+    positions = np.minimum(np.searchsorted(rows, candidates), len(rows) - 1)
+    return rows[positions] == candidates
+
+
+def scores(prefix, coverage, distances, ratings, reviews):
+    """Blend of text match, proximity (when distances are known) and rating, 0 to 1"""
+    text = np.where(prefix, 1.0, 0.6) * (0.7 + 0.3 * np.clip(coverage, 0.0, 1.0))
+    ratings = np.nan_to_num(np.asarray(ratings, dtype=np.float64))
+    reviews = np.nan_to_num(np.asarray(reviews, dtype=np.float64))
+    quality = ratings / 5.0 * np.minimum(np.log1p(reviews) / REVIEWS_SCALE, 1.0)
+    total = TEXT_WEIGHT * text + RATING_WEIGHT * quality
+    if distances is not None:
+        total = total + DISTANCE_WEIGHT * np.exp(-np.asarray(distances) / DISTANCE_SCALE)
+    return total
+
+
+def top_order(values, count):
+    """Indices of the count highest values, highest first"""
+    if count < len(values):
+        best = np.argpartition(-values, count)[:count]
+        return best[np.argsort(-values[best], kind='stable')]
+    return np.argsort(-values, kind='stable')
+
+
+def _verified(query, order, names_of, limit):
+    """The first limit positions of order whose names really contain the query
+
+    Trigrams can all occur in a name without spelling the query in a row,
+    so multi-trigram matches are checked on the decoded names, a bounded
+    number of them per result.
+    """
+    if query.exact:
+        return order[:limit]
+    kept = []
+    for position in order[:limit * VERIFY_FACTOR].tolist():
+        if query.matches(*names_of(position)):
+            kept.append(position)
+            if len(kept) == limit:
+                break
+    return np.array(kept, dtype=np.int64)
+
+
+def search_store(store, query, lat=None, lon=None, radius=None, limit=10):
+    """[(score, restaurant)] of a RestaurantStore matching query, best first
+
+    With a position, results get a distance and, with a radius too, only
+    rows within radius meters are considered; the store's geohash row
+    order lets the radius cut the posting lists before they are merged.
+    """
+    if store.name_index is None or not query.valid:
+        return []
+    keys, offsets, postings = store.name_index
+
+    def postings_of(key):
+        index = np.searchsorted(keys, np.uint64(key))
+        if index == len(keys) or keys[index] != key:
+            return postings[:0]
+        return postings[offsets[index]:offsets[index + 1]]
+
+    if any(not len(postings_of(key)) for key in query.keys):
+        return []
+    ranges = store.radius_ranges(lat, lon, radius) if lat is not None and radius else None
+    rows = match_rows(postings_of, query.keys, ranges)
+    distances = None
+    if lat is not None and len(rows):
+        distances = haversine_many(lat, lon, store.columns['lat'][rows], store.columns['lon'][rows])
+        if radius:
+            inside = distances <= radius
+            rows, distances = rows[inside], distances[inside]
+    if not len(rows):
+        return []
+
+    name_lengths = store.name_lengths(rows)
+    values = scores(contains(postings_of(query.prefix_key), rows), query.length / np.maximum(name_lengths, 1),
+                    distances, store.columns['rating'][rows], store.columns['reviews'][rows])
+    order = top_order(values, limit if query.exact else limit * VERIFY_FACTOR)
+    order = _verified(query, order, lambda i: (store.string('name', int(rows[i])),
+                                               store.string('name_en', int(rows[i]))), limit)
+
+    results = []
+    for i in order.tolist():
+        restaurant = store.restaurant(int(rows[i]))
+        if distances is not None:
+            restaurant['distance'] = round(float(distances[i]))
+        results.append((float(values[i]), restaurant))
+    return results
+
+
+class NameIndex:
+    """Growable trigram index over the names of restaurants fetched from Places
+
+    Complements the store's persisted index with whatever the worker has
+    cached. A restaurant keeps its name in every language it was fetched
+    in, so fetching it in English leaves its Thai name searchable. Posting
+    lists and grid cells only ever grow: a restaurant whose names or
+    position change moves to a new row and its old row is retired, and the
+    lists are rebuilt once retired rows outnumber live ones.
+
+    Like SpatialIndex, restaurants not added again within item_ttl seconds
+    are dropped, and past max_items the least recently added ones are.
+    """
+
+    def __init__(self, cell_size=0.05, max_items=200000, item_ttl=None):
+        self.cell_size = cell_size  # degrees, ~5.5km at the equator
+        self.max_items = max_items
+        self.item_ttl = item_ttl
+        self._rows = {}  # key -> live row
+        self._added = OrderedDict()  # key -> time it was last added, oldest first
+        self._names = {}  # key -> {language: name}
+        self._lock = RLock()
+        self._reset()
+
+    def _reset(self):
+        self._postings = {}
+        self._cells = {}
+        self._keys = []
+        self._items = []
+        self._row_names = []
+        self._lengths = array('d')
+        self._ratings = array('d')
+        self._reviews = array('d')
+        self._lats = array('d')
+        self._lons = array('d')
+        self._live = bytearray()
+        self._retired = 0
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _cell(self, lat, lon):
+        return int(math.floor(lat / self.cell_size)), int(math.floor(lon / self.cell_size))
+
+    def add(self, key, restaurant, language='th'):
+        """Insert or update a restaurant identified by key, as fetched in language"""
+        with self._lock:
+            now = time.time()
+            self._added[key] = now
+            self._added.move_to_end(key)
+            self._expire(now)
+
+            names = self._names.setdefault(key, {})
+            if restaurant.get('name') and restaurant['name'] not in PLACEHOLDERS:
+                names[language] = restaurant['name']
+            item = dict(restaurant)
+            # The Thai name is the name; an English one, when known, goes alongside
+            item['name'] = names.get('th') or restaurant.get('name')
+            if names.get('en') and names['en'] != item['name']:
+                item['name_en'] = names['en']
+            row_names = tuple(dict.fromkeys(filter(None, (item.get('name'), item.get('name_en'), *names.values()))))
+
+            row = self._rows.get(key)
+            if row is not None:
+                if (row_names == self._row_names[row] and self._lats[row] == restaurant['lat']
+                        and self._lons[row] == restaurant['lng']):
+                    self._items[row] = item
+                    return
+                self._retire(row)
+            self._append(key, item, row_names)
+            if self._retired > len(self._rows):
+                self._rebuild()
+
+    def _append(self, key, item, row_names):
+        row = len(self._items)
+        self._rows[key] = row
+        self._keys.append(key)
+        self._items.append(item)
+        self._row_names.append(row_names)
+        text = ' '.join(filter(None, map(search_text, row_names)))
+        self._lengths.append(len(text.encode('utf-8')))
+        self._ratings.append(item.get('rating') or 0)
+        self._reviews.append(item.get('user_ratings_total') or 0)
+        self._lats.append(item['lat'])
+        self._lons.append(item['lng'])
+        self._live.append(1)
+        # Rows only ever grow, so appending keeps every list sorted
+        for trigram in set(trigram_keys(text).tolist()):
+            self._postings.setdefault(trigram, array('q')).append(row)
+        self._cells.setdefault(self._cell(item['lat'], item['lng']), array('q')).append(row)
+
+    def _retire(self, row):
+        self._live[row] = 0
+        self._items[row] = None
+        self._retired += 1
+
+    def _rebuild(self):
+        """Reindex the live rows from scratch, dropping the retired ones"""
+        live = sorted(self._rows.values())
+        rows = [(self._keys[row], self._items[row], self._row_names[row]) for row in live]
+        self._rows = {}
+        self._reset()
+        for key, item, row_names in rows:
+            self._append(key, item, row_names)
+
+    def _expire(self, now):
+        """Drop the restaurants added longest ago while over max_items or older than item_ttl"""
+        while self._added:
+            key, added_at = next(iter(self._added.items()))
+            if len(self._added) <= self.max_items and (self.item_ttl is None or added_at > now - self.item_ttl):
+                break
+            del self._added[key]
+            self._names.pop(key, None)
+            row = self._rows.pop(key, None)
+            if row is not None:
+                self._retire(row)
+
+    def _near(self, lat, lon, radius):
+        """Row lists of the grid cells a circle touches"""
+        lat_span = radius / METERS_PER_DEGREE
+        lon_span = radius / (METERS_PER_DEGREE * max(math.cos(math.radians(min(abs(lat) + lat_span, 89.0))), 0.01))
+        min_y, min_x = self._cell(lat - lat_span, lon - lon_span)
+        max_y, max_x = self._cell(lat + lat_span, lon + lon_span)
+        cells = (self._cells.get((y, x)) for y in range(min_y, max_y + 1) for x in range(min_x, max_x + 1))
+        return [rows for rows in cells if rows]
+
+    def search(self, query, lat=None, lon=None, radius=None, limit=10):
+        """[(score, restaurant)] matching query, best first; see search_store()"""
+        if not query.valid:
+            return []
+
+        def postings_of(key):
+            rows = self._postings.get(key)
+            # A view, released before the lock is: while it lives the list cannot grow
+            return np.frombuffer(rows, dtype=np.int64) if rows else np.empty(0, dtype=np.int64)
+
+        with self._lock:
+            within = None
+            if lat is not None and radius:
+                near = self._near(lat, lon, radius)
+                rarest = min(len(self._postings.get(key, ())) for key in query.keys)
+                # Cutting to the circle first pays off when it leaves fewer rows to probe, or
+                # keeps a sample of a common term's matches from landing mostly out of range
+                if sum(map(len, near)) < rarest or rarest > MAX_CANDIDATES:
+                    within = np.concatenate([np.frombuffer(rows, dtype=np.int64) for rows in near]
+                                            or [np.empty(0, dtype=np.int64)])
+            rows = match_rows(postings_of, query.keys, within=within)
+            if len(rows):
+                rows = rows[np.frombuffer(self._live, dtype=np.uint8)[rows] != 0]
+            distances = None
+            if lat is not None and len(rows):
+                distances = haversine_many(lat, lon, np.frombuffer(self._lats, dtype=np.float64)[rows],
+                                           np.frombuffer(self._lons, dtype=np.float64)[rows])
+                if radius:
+                    inside = distances <= radius
+                    rows, distances = rows[inside], distances[inside]
+            if not len(rows):
+                return []
+
+            lengths = np.frombuffer(self._lengths, dtype=np.float64)[rows]
+            values = scores(contains(postings_of(query.prefix_key), rows), query.length / np.maximum(lengths, 1),
+                            distances, np.frombuffer(self._ratings, dtype=np.float64)[rows],
+                            np.frombuffer(self._reviews, dtype=np.float64)[rows])
+            order = top_order(values, limit if query.exact else limit * VERIFY_FACTOR)
+            order = _verified(query, order, lambda i: self._row_names[rows[i]], limit)
+
+            results = []
+            for i in order.tolist():
+                restaurant = dict(self._items[rows[i]])
+                if distances is not None:
+                    restaurant['distance'] = round(float(distances[i]))
+                results.append((float(values[i]), restaurant))
+            return results
@@ -0,0 +1,374 @@
+import bz2
+import gzip
+import io
+import json
+import logging
+import os
+import time
+import xml.etree.ElementTree as ET
+
+from lazy_imports import lazy_module
+from restaurant_store import KINDS, RestaurantStore, StoreWriter, osm_key, write_generation
+
+np = lazy_module('numpy')
+
+logger = logging.getLogger(__name__)
+
+AMENITIES = frozenset(KINDS)
+
+# Characters of an Overpass JSON dump read at a time
+JSON_CHUNK_SIZE = 1 << 20
+
+# addr:* tags joined into the vicinity line, most specific first
+ADDRESS_TAGS = ('addr:housenumber', 'addr:street', 'addr:subdistrict', 'addr:district', 'addr:city', 'addr:province')
+
+
+def _open(path):
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rb')
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def vicinity(tags):
+    parts = []
+    for tag in ADDRESS_TAGS:
+        value = tags.get(tag)
+        if value and value not in parts:
+            parts.append(value)
+    return ' '.join(parts) or tags.get('addr:full')
+
+
+def _rating(tags):
+    # OSM has no ratings; some mappers tag stars, which is the closest thing
+    try:
+        return min(max(float(tags.get('stars', 0)), 0.0), 5.0)
+    except ValueError:
+        return 0.0
+
+
+def _add(writer, osm_type, osm_id, lat, lon, tags):
+    writer.add(
+        lat, lon, tags['amenity'], osm_key(osm_type, osm_id),
+        name=tags.get('name:th') or tags.get('name'),
+        name_en=tags.get('name:en'),
+        vicinity=vicinity(tags),
+        cuisine=tags.get('cuisine'),
+        rating=_rating(tags)
+    )
+
+
+def _tags(elem):
+    return {tag.get('k'): tag.get('v') for tag in elem.iter('tag')}
+
+
+def _iter_xml(path, tags=('node', 'way')):
+    """Yield top level OSM XML elements, dropping each once handled so memory stays flat"""
+    with _open(path) as f:
+        root = None
+        for event, elem in ET.iterparse(f, events=('start', 'end')):
+            if root is None:
+                root = elem
+            elif event == 'end' and elem.tag in ('node', 'way', 'relation'):
+                if elem.tag in tags:
+                    yield elem
+                # Detach it from the root too, or the emptied elements still pile up
+                root.clear()
+
+
+def import_xml(path, writer):
+    """Import restaurants from an .osm (optionally .bz2/.gz) XML extract
+
+    Nodes are read in the first pass. Ways only list node ids, so the first
+    pass also remembers the nodes referenced by matching ways and a second
+    pass collects just those coordinates to place each way at its centroid;
+    the extract's millions of other nodes are never held in memory.
+    """
+    way_refs = {}
+    for elem in _iter_xml(path):
+        tags = _tags(elem)
+        if tags.get('amenity') not in AMENITIES:
+            continue
+        if elem.tag == 'node':
+            _add(writer, 'node', elem.get('id'), float(elem.get('lat')), float(elem.get('lon')), tags)
+        else:
+            refs = [int(nd.get('ref')) for nd in elem.iter('nd')]
+            if refs:
+                way_refs[int(elem.get('id'))] = (refs, tags)
+
+    if not way_refs:
+        return
+    needed = {ref for refs, _ in way_refs.values() for ref in refs}
+    coordinates = {}
+    for elem in _iter_xml(path, tags=('node',)):
+        node_id = int(elem.get('id'))
+        if node_id in needed:
+            coordinates[node_id] = (float(elem.get('lat')), float(elem.get('lon')))
+
+    for way_id, (refs, tags) in way_refs.items():
+        points = [coordinates[ref] for ref in refs if ref in coordinates]
+        if not points:
+            logger.warning(f"Skipping way {way_id}: none of its nodes are in the extract")
+            continue
+        _add(writer, 'way', way_id, sum(p[0] for p in points) / len(points),
+             sum(p[1] for p in points) / len(points), tags)
+
+
+class _JsonStream:
+    """Reads a JSON document one value at a time, holding one chunk and the current value
+
+    json.load would hold a country's whole Overpass dump, and every element
+    parsed from it, at once; this lets the importer walk the elements array
+    element by element instead.
+    """
+
+    def __init__(self, f):
+        self._file = f
+        self._buffer = ''
+        self._position = 0
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+
+    def _fill(self):
+        chunk = self._file.read(JSON_CHUNK_SIZE)
+        self._eof = not chunk
+        self._buffer = self._buffer[self._position:] + chunk
+        self._position = 0
+
+    def peek(self):
+        """The next non-whitespace character, or '' at the end"""
+        while True:
+            while self._position < len(self._buffer) and self._buffer[self._position].isspace():
+                self._position += 1
+            if self._position < len(self._buffer) or self._eof:
+                return self._buffer[self._position:self._position + 1]
+            self._fill()
+
+    def expect(self, chars):
+        """Consume the next character, which must be one of chars, and return it"""
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError(f"Malformed JSON: expected one of {chars!r}, found {char or 'the end'!r}")
+        self._position += 1
+        return char
+
+    def value(self):
+        """Decode the next complete value"""
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._position)
+                # A number or literal cut off at the end of the chunk would still decode
+                if end < len(self._buffer) or self._eof:
+                    self._position = end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            self._fill()
+
+
+def _iter_overpass_elements(path):
+    """Yield the elements of an Overpass JSON dump one by one, skipping its other keys"""
+    with _open(path) as raw, io.TextIOWrapper(raw, encoding='utf-8') as f:
+        stream = _JsonStream(f)
+        stream.expect('{')
+        if stream.peek() == '}':
+            return
+        while True:
+            key = stream.value()
+            stream.expect(':')
+            if key != 'elements':
+                stream.value()
+            else:
+                stream.expect('[')
+                if stream.peek() == ']':
+                    stream.expect(']')
+                else:
+                    while True:
+                        yield stream.value()
+                        if stream.expect(',]') == ']':
+                            break
+            if stream.expect(',}') == '}':
+                return
+
+
+def import_overpass_json(path, writer):
+    """Import restaurants from an Overpass API JSON dump (`out center;` gives ways a position)
+
+    The dump is streamed, so memory stays flat however large it is.
+    """
+    for element in _iter_overpass_elements(path):
+        tags = element.get('tags') or {}
+        if tags.get('amenity') not in AMENITIES or element.get('type') not in ('node', 'way'):
+            continue
+        position = element if 'lat' in element else element.get('center')
+        if not position:
+            continue
+        _add(writer, element['type'], element['id'], position['lat'], position['lon'], tags)
+
+
+def import_pbf(path, writer):
+    """Import restaurants from an .osm.pbf extract (needs the optional osmium package)"""
+    try:
+        import osmium
+    except ImportError:
+        raise RuntimeError('Reading .osm.pbf needs the osmium package (pip install osmium)')
+
+    class Handler(osmium.SimpleHandler):
+        def node(self, node):
+            if node.tags.get('amenity') in AMENITIES:
+                _add(writer, 'node', node.id, node.location.lat, node.location.lon, dict(node.tags))
+
+        def way(self, way):
+            if way.tags.get('amenity') not in AMENITIES:
+                return
+            points = [(nd.location.lat, nd.location.lon) for nd in way.nodes if nd.location.valid()]
+            if points:
+                _add(writer, 'way', way.id, sum(p[0] for p in points) / len(points),
+                     sum(p[1] for p in points) / len(points), dict(way.tags))
+
+    # The sparse file-backed location index keeps node positions out of RAM
+    node_cache = f"{path}.nodecache"
+    try:
+        Handler().apply_file(path, locations=True, idx=f"sparse_file_array,{node_cache}")
+    finally:
+        if os.path.exists(node_cache):
+            os.remove(node_cache)
+
+
+def import_extract(path, output):
+    """Import an OSM extract as a new generation of the store published at output
+
+    Returns (generation, row count).
+    """
+    started = time.perf_counter()
+    writer = StoreWriter()
+    if path.endswith('.pbf'):
+        import_pbf(path, writer)
+    elif path.endswith(('.json', '.json.gz', '.json.bz2')):
+        import_overpass_json(path, writer)
+    else:
+        import_xml(path, writer)
+
+    generation = write_generation(writer, output, metadata={'source': path})
+    logger.info(f"Imported {len(writer)} restaurants from {path} in {time.perf_counter() - started:.1f}s")
+    return generation, len(writer)
+
+
+def read_changes(path):
+    """Read an osmChange (.osc, optionally .gz/.bz2) diff
+
+    Returns (upserts, removed): upserts maps the osm_key of each created or
+    modified restaurant to (osm type, id, position or None, tags), and
+    removed holds the keys of deleted elements and of elements that are no
+    longer restaurants (e.g. closed places whose amenity tag was dropped).
+    Ways get the centroid of those of their nodes the diff carries; nodes
+    without coordinates (e.g. a tag-only modify) get None.
+    """
+    upserts = {}
+    removed = set()
+    way_refs = {}
+    node_positions = {}
+    action = None
+    with _open(path) as f:
+        root = None
+        for event, elem in ET.iterparse(f, events=('start', 'end')):
+            if root is None:
+                root = elem
+                continue
+            if event == 'start':
+                if elem.tag in ('create', 'modify', 'delete'):
+                    action = elem.tag
+                continue
+            if elem.tag in ('create', 'modify', 'delete'):
+                root.clear()
+                continue
+            if elem.tag not in ('node', 'way'):
+                continue
+
+            key = osm_key(elem.tag, elem.get('id'))
+            tags = _tags(elem)
+            if elem.tag == 'node' and action != 'delete' and elem.get('lat') is not None:
+                node_positions[int(elem.get('id'))] = (float(elem.get('lat')), float(elem.get('lon')))
+            if action == 'delete' or tags.get('amenity') not in AMENITIES:
+                removed.add(key)
+                upserts.pop(key, None)
+            elif elem.tag == 'node':
+                upserts[key] = ('node', int(elem.get('id')), node_positions.get(int(elem.get('id'))), tags)
+                removed.discard(key)
+            else:
+                way_refs[key] = [int(nd.get('ref')) for nd in elem.iter('nd')]
+                upserts[key] = ('way', int(elem.get('id')), None, tags)
+                removed.discard(key)
+            elem.clear()
+
+    for key, refs in way_refs.items():
+        if key not in upserts:
+            continue
+        points = [node_positions[ref] for ref in refs if ref in node_positions]
+        if points:
+            osm_type, osm_id, _, tags = upserts[key]
+            upserts[key] = (osm_type, osm_id, (sum(p[0] for p in points) / len(points),
+                                               sum(p[1] for p in points) / len(points)), tags)
+    return upserts, removed
+
+
+def apply_changes(store, change_paths, writer):
+    """Write store's rows with the osmChange diffs applied, in order, into writer
+
+    Untouched rows are copied over as stored. A changed way whose nodes are
+    not in the diffs, or a changed node without coordinates, keeps its
+    previous position, or is skipped if it is new.
+    Returns {kept, upserted, removed, skipped}.
+    """
+    upserts, removed = {}, set()
+    for change_path in change_paths:
+        changed, gone = read_changes(change_path)
+        for key in gone:
+            upserts.pop(key, None)
+        removed |= gone
+        for key, change in changed.items():
+            if change[2] is None and key in upserts:
+                # Only the tags changed this time; keep the position an earlier diff gave
+                change = change[:2] + (upserts[key][2],) + change[3:]
+            upserts[key] = change
+            removed.discard(key)
+
+    keys = store.columns['osm_key']
+    touched = np.isin(keys, np.fromiter(set(upserts) | removed, dtype=np.int64))
+    writer.copy_rows(store, np.flatnonzero(~touched))
+    previous = {key: row for key, row in zip(keys[touched].tolist(), np.flatnonzero(touched).tolist())}
+
+    stats = {'kept': len(keys) - len(previous), 'upserted': 0,
+             'removed': len(removed & previous.keys()), 'skipped': 0}
+    for key, (osm_type, osm_id, position, tags) in upserts.items():
+        if position is None and key in previous:
+            row = previous[key]
+            position = (float(store.columns['lat'][row]), float(store.columns['lon'][row]))
+        if position is None:
+            logger.warning(f"Skipping {osm_type} {osm_id}: the diffs give no position for it")
+            stats['skipped'] += 1
+            continue
+        _add(writer, osm_type, osm_id, position[0], position[1], tags)
+        stats['upserted'] += 1
+    return stats
+
+
+def update_dataset(output, change_paths):
+    """Apply osmChange diffs to the store published at output as a new generation
+
+    The current generation is only read, so workers keep serving it while
+    the next one is built; they switch once it is published.
+    Returns (generation, stats).
+    """
+    started = time.perf_counter()
+    store = RestaurantStore(output)
+    writer = StoreWriter()
+    stats = apply_changes(store, change_paths, writer)
+    metadata = dict(store.header['metadata'], changes=list(change_paths))
+    generation = write_generation(writer, output, metadata=metadata)
+    store.close()
+    logger.info(f"Updated {output} to generation {generation} in {time.perf_counter() - started:.1f}s: {stats}")
+    return generation, stats
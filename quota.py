@@ -0,0 +1,161 @@
+import hashlib
+import logging
+import time
+from datetime import datetime, timedelta
+from threading import Lock
+
+from lazy_imports import lazy_module
+
+pytz = lazy_module('pytz')
+logger = logging.getLogger(__name__)
+
+# Budget modes, from no restrictions to no upstream calls at all
+NORMAL = 'normal'
+CONSERVE = 'conserve'
+CACHE_ONLY = 'cache_only'
+
+
+class QuotaExceeded(Exception):
+    """The upstream budget does not allow another call right now"""
+
+
+class QuotaBudget:
+    """Counts calls made with one API key per minute and per day against fixed budgets
+
+    Counters live in the shared store (shared_cache.SharedCache) so every
+    worker on the host spends from the same budget; without a store they are
+    per process. Days start at midnight in `timezone`, matching when the
+    provider resets its daily quota. A limit of None or 0 means unlimited.
+
+    mode() condenses the remaining budget into NORMAL, CONSERVE (running low,
+    or spending faster than the day goes by) or CACHE_ONLY (nearly exhausted).
+    """
+
+    def __init__(self, name, api_key=None, per_minute=None, per_day=None, timezone='UTC', store=None,
+                 conserve_ratio=0.3, cache_only_ratio=0.05, pace_margin=0.1, refresh_interval=1.0):
+        # Count per key, without keeping the key itself around
+        key_id = hashlib.sha1((api_key or '').encode()).hexdigest()[:12]
+        self.name = f"{name}:{key_id}"
+        self.limits = {'minute': per_minute or None, 'day': per_day or None}
+        self.timezone = timezone
+        self.store = store
+        self.conserve_ratio = conserve_ratio
+        self.cache_only_ratio = cache_only_ratio
+        self.pace_margin = pace_margin
+        self.refresh_interval = refresh_interval
+        self._local_counts = {}
+        self._usage = None
+        self._usage_at = 0
+        self._lock = Lock()
+
+    def _periods(self, now):
+        """[(window, period key, starts_at, ends_at)] of the periods containing now"""
+        tz = pytz.timezone(self.timezone)
+        local = datetime.fromtimestamp(now, tz)
+        midnight = datetime(local.year, local.month, local.day)
+        # Localize both ends separately so days with a DST change get their real length
+        day_start = tz.localize(midnight)
+        day_end = tz.localize(midnight + timedelta(days=1))
+        minute_start = int(now // 60) * 60
+        return [
+            ('minute', f"minute:{minute_start}", minute_start, minute_start + 60),
+            ('day', f"day:{day_start.date().isoformat()}", day_start.timestamp(), day_end.timestamp())
+        ]
+
+    def acquire(self, amount=1):
+        """Count amount calls, or raise QuotaExceeded if the budget does not allow them"""
+        now = time.time()
+        if self.mode() == CACHE_ONLY:
+            raise QuotaExceeded(f"{self.name} budget reserved, serving from cache only")
+
+        periods = [(key, self.limits[window], ends_at) for window, key, _, ends_at in self._periods(now)]
+        counts = None
+        if self.store is not None:
+            try:
+                counts = self.store.consume(self.name, periods, amount)
+                if counts is None:
+                    raise QuotaExceeded(f"{self.name} budget exhausted")
+            except QuotaExceeded:
+                raise
+            except Exception as e:
+                logger.warning(f"Shared quota counters unavailable, counting locally: {str(e)}")
+                counts = None
+
+        if counts is None:
+            with self._lock:
+                self._local_counts = {key: count for key, count in self._local_counts.items()
+                                      if key in {period for period, _, _ in periods}}
+                counts = {period: self._local_counts.get(period, 0) + amount for period, _, _ in periods}
+                if any(limit is not None and counts[period] > limit for period, limit, _ in periods):
+                    raise QuotaExceeded(f"{self.name} budget exhausted")
+                self._local_counts.update(counts)
+
+        with self._lock:
+            # Fresh counts are free here, so keep mode() current without another read
+            self._usage = self._build_usage(now, counts)
+            self._usage_at = now
+
+    def usage(self):
+        """Return {window: {used, limit, remaining, resets_at}} for the current minute and day"""
+        now = time.time()
+        with self._lock:
+            if self._usage is not None and now - self._usage_at < self.refresh_interval:
+                return self._usage
+
+        keys = [key for _, key, _, _ in self._periods(now)]
+        counts = None
+        if self.store is not None:
+            try:
+                counts = self.store.read_counters(self.name, keys)
+            except Exception as e:
+                logger.warning(f"Shared quota counters unavailable, using local counts: {str(e)}")
+        if counts is None:
+            with self._lock:
+                counts = {key: self._local_counts.get(key, 0) for key in keys}
+
+        usage = self._build_usage(now, counts)
+        with self._lock:
+            self._usage = usage
+            self._usage_at = now
+        return usage
+
+    def _build_usage(self, now, counts):
+        usage = {}
+        for window, key, starts_at, ends_at in self._periods(now):
+            limit = self.limits[window]
+            used = counts.get(key, 0)
+            usage[window] = {
+                'used': used,
+                'limit': limit,
+                'remaining': None if limit is None else max(limit - used, 0),
+                'resets_at': ends_at,
+                'elapsed': (now - starts_at) / (ends_at - starts_at)
+            }
+        return usage
+
+    def mode(self):
+        """Return NORMAL, CONSERVE or CACHE_ONLY for the budget left right now"""
+        usage = self.usage()
+        mode = NORMAL
+        for window, window_usage in usage.items():
+            limit = window_usage['limit']
+            if limit is None:
+                continue
+            left = window_usage['remaining'] / limit
+            if left <= 0 or (window == 'day' and left <= self.cache_only_ratio):
+                return CACHE_ONLY
+            if left <= self.conserve_ratio:
+                mode = CONSERVE
+            # Spending ahead of the clock would run the day's budget dry before it resets
+            if window == 'day' and window_usage['used'] / limit > window_usage['elapsed'] + self.pace_margin:
+                mode = CONSERVE
+        return mode
+
+    def stats(self):
+        usage = self.usage()
+        return {
+            'name': self.name,
+            'mode': self.mode(),
+            'windows': {window: {key: value for key, value in window_usage.items() if key != 'elapsed'}
+                        for window, window_usage in usage.items()}
+        }
@@ -0,0 +1,50 @@
+from geo import EARTH_RADIUS
+from lazy_imports import lazy_module
+
+np = lazy_module('numpy')
+
+
+def haversine_many(lat, lon, lats, lons):
+    """Distances in meters from one point to arrays of points
+
+    Vectorized version of geo.calculate_distance, which stays the scalar
+    reference implementation.
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    phi1 = np.radians(lat)
+    phi2 = np.radians(lats)
+    delta_phi = phi2 - phi1
+    delta_lambda = np.radians(lons - lon)
+
+    a = np.sin(delta_phi / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(delta_lambda / 2) ** 2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    return EARTH_RADIUS * c
+
+
+def rank_order(distances, ratings, reviews):
+    """Indices ordered by rating (highest first), then review count, then distance"""
+    distances = np.asarray(distances, dtype=np.float64)
+    ratings = np.nan_to_num(np.asarray(ratings, dtype=np.float64))
+    reviews = np.nan_to_num(np.asarray(reviews, dtype=np.float64))
+    # lexsort uses the last key as the primary one
+    return np.lexsort((distances, -reviews, -ratings))
+
+
+def rank_restaurants(lat, lon, lats, lons, ratings, reviews, radius=None, limit=None):
+    """Compute distances and the ranked order of candidates in one vectorized pass
+
+    Takes column arrays for the candidates and returns (distances, order) where
+    order holds the indices of candidates within radius, best first.
+    """
+    distances = haversine_many(lat, lon, lats, lons)
+    candidates = np.arange(len(distances))
+    if radius is not None:
+        candidates = np.flatnonzero(distances <= radius)
+
+    order = candidates[rank_order(distances[candidates],
+                                  np.asarray(ratings, dtype=np.float64)[candidates],
+                                  np.asarray(reviews, dtype=np.float64)[candidates])]
+    if limit is not None:
+        order = order[:limit]
+    return distances, order
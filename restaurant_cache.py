@@ -0,0 +1,106 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class TileCache:
+    """Thread-safe LRU cache with per-entry TTL for processed search results
+
+    When a shared backend (see shared_cache.SharedCache) is given, it acts as a
+    second tier: in-process misses fall through to it and writes go to both.
+
+    With stale_ttl, entries are kept that much longer after they expire so
+    get_entry() can still serve them while a fresh copy is being fetched.
+    """
+
+    def __init__(self, max_entries=5000, ttl=900, backend=None, namespace='restaurants', stale_ttl=0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.backend = backend
+        self.namespace = namespace
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.backend_hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return the cached value for key, or None if missing or expired"""
+        entry = self.get_entry(key)
+        if entry is None:
+            return None
+        value, fresh_until = entry
+        if fresh_until <= time.time():
+            return None
+        return value
+
+    def get_entry(self, key):
+        """Return (value, fresh_until) for key, including stale entries, or None if missing"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                fresh_until, expires_at, value = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    if fresh_until > now:
+                        self.hits += 1
+                    else:
+                        self.stale_hits += 1
+                    return value, fresh_until
+                del self._entries[key]
+
+        if self.backend is not None:
+            entry = self.backend.get_entry(self.namespace, self._backend_key(key))
+            if entry is not None:
+                value, expires_at = entry
+                fresh_until = expires_at - self.stale_ttl
+                # Keep the entry in process no longer than the shared copy lives
+                self._store(key, value, min(self.ttl, fresh_until - now))
+                with self._lock:
+                    self.backend_hits += 1
+                return value, fresh_until
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key, value, ttl=None):
+        """Store value under key, evicting the least recently used entries"""
+        ttl = self.ttl if ttl is None else ttl
+        self._store(key, value, ttl)
+        if self.backend is not None:
+            self.backend.set(self.namespace, self._backend_key(key), value, ttl + self.stale_ttl)
+
+    def _store(self, key, value, ttl):
+        fresh_until = time.time() + ttl
+        with self._lock:
+            self._entries[key] = (fresh_until, fresh_until + self.stale_ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    @staticmethod
+    def _backend_key(key):
+        if isinstance(key, tuple):
+            return ':'.join(str(part) for part in key)
+        return str(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'stale_ttl': self.stale_ttl,
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'backend_hits': self.backend_hits,
+                'misses': self.misses
+            }
@@ -0,0 +1,446 @@
+import glob
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import time
+from array import array
+from threading import Lock
+
+from geo import geohash_cells_in_bbox, geohash_to_int
+from lazy_imports import lazy_module
+from name_search import build_trigram_index, search_text
+from ranking import haversine_many
+from spatial_index import METERS_PER_DEGREE
+
+np = lazy_module('numpy')
+logger = logging.getLogger(__name__)
+
+# File layout: MAGIC, a little-endian u32 header length, the JSON header, then
+# each column and string table at the 8-byte aligned offset the header gives.
+MAGIC = b'RSTORE01'
+ALIGNMENT = 8
+
+# Rows are sorted by the geohash of their position at this precision (30 bits),
+# so every geohash cell of this size or larger is one contiguous row range
+CODE_PRECISION = 6
+
+KINDS = ('restaurant', 'cafe', 'fast_food', 'food_court')
+OSM_TYPES = ('node', 'way', 'relation')
+
+COLUMNS = (
+    ('cell', '<u4'),
+    ('lat', '<f8'),
+    ('lon', '<f8'),
+    ('rating', '<f4'),
+    ('reviews', '<u4'),
+    ('kind', '<u1'),
+    ('osm_key', '<i8'),  # osm id << 2 | index in OSM_TYPES
+)
+STRING_FIELDS = ('name', 'name_en', 'vicinity', 'cuisine')
+
+# Generations are written next to the published path as <path>.<generation>,
+# and the path itself is a symlink to the current one
+GENERATION_DIGITS = 6
+KEEP_GENERATIONS = 3
+
+# Fallbacks matching what the Places path shows for missing fields
+NO_NAME = 'ไม่ระบุชื่อ'
+NO_VICINITY = 'ไม่ระบุที่อยู่'
+
+
+def osm_key(osm_type, osm_id):
+    return (int(osm_id) << 2) | OSM_TYPES.index(osm_type)
+
+
+def osm_ref(key):
+    """'node/123' style reference of an osm_key"""
+    return f"{OSM_TYPES[key & 3]}/{key >> 2}"
+
+
+def cell_codes(lats, lons, precision=CODE_PRECISION):
+    """Geohash bits of many points at once, as integers (see geo.geohash_to_int)"""
+    bits = 5 * precision
+    lon_bits = (bits + 1) // 2
+    lat_bits = bits // 2
+    lat_cells = np.clip(((np.asarray(lats) + 90.0) / 180.0 * (1 << lat_bits)).astype(np.int64), 0, (1 << lat_bits) - 1)
+    lon_cells = np.clip(((np.asarray(lons) + 180.0) / 360.0 * (1 << lon_bits)).astype(np.int64), 0, (1 << lon_bits) - 1)
+
+    # Interleave the bits, longitude first, most significant first
+    codes = np.zeros(len(lat_cells), dtype=np.int64)
+    for bit in range(bits):
+        if bit % 2 == 0:
+            source, position = lon_cells, lon_bits - 1 - bit // 2
+        else:
+            source, position = lat_cells, lat_bits - 1 - bit // 2
+        codes = (codes << 1) | ((source >> position) & 1)
+    return codes
+
+
+class StoreWriter:
+    """Collects restaurants in compact arrays and writes them as one store file
+
+    Memory stays proportional to the restaurants kept, not to the size of the
+    source the importer streams them from.
+    """
+
+    def __init__(self):
+        self._lats = array('d')
+        self._lons = array('d')
+        self._ratings = array('f')
+        self._reviews = array('L')
+        self._kinds = array('B')
+        self._osm_keys = array('q')
+        self._strings = {field: [] for field in STRING_FIELDS}
+
+    def __len__(self):
+        return len(self._lats)
+
+    def add(self, lat, lon, kind, osm_key, name=None, name_en=None, vicinity=None, cuisine=None,
+            rating=0.0, reviews=0):
+        self._lats.append(lat)
+        self._lons.append(lon)
+        self._ratings.append(rating or 0.0)
+        self._reviews.append(reviews or 0)
+        self._kinds.append(KINDS.index(kind))
+        self._osm_keys.append(osm_key)
+        for field, value in zip(STRING_FIELDS, (name, name_en, vicinity, cuisine)):
+            self._strings[field].append(value.encode('utf-8') if value else b'')
+
+    def copy_rows(self, store, rows):
+        """Append rows of an existing RestaurantStore as they are, without decoding strings"""
+        rows = np.asarray(rows, dtype=np.int64)
+        self._lats.extend(store.columns['lat'][rows].tolist())
+        self._lons.extend(store.columns['lon'][rows].tolist())
+        self._ratings.extend(store.columns['rating'][rows].tolist())
+        self._reviews.extend(store.columns['reviews'][rows].tolist())
+        self._kinds.extend(store.columns['kind'][rows].tolist())
+        self._osm_keys.extend(store.columns['osm_key'][rows].tolist())
+        for field in STRING_FIELDS:
+            offsets, data = store._strings[field]
+            starts = offsets[rows].tolist()
+            ends = offsets[rows + 1].tolist()
+            self._strings[field].extend(bytes(data[start:end]) for start, end in zip(starts, ends))
+
+    def write(self, path, metadata=None):
+        """Write the store to path atomically (readers never see a partial file)"""
+        lats = np.frombuffer(self._lats, dtype=np.float64)
+        lons = np.frombuffer(self._lons, dtype=np.float64)
+        codes = cell_codes(lats, lons)
+        order = np.argsort(codes, kind='stable')
+
+        columns = {
+            'cell': codes[order].astype('<u4'),
+            'lat': lats[order].astype('<f8'),
+            'lon': lons[order].astype('<f8'),
+            'rating': np.frombuffer(self._ratings, dtype=np.float32)[order].astype('<f4'),
+            'reviews': np.frombuffer(self._reviews, dtype=np.dtype(f"u{self._reviews.itemsize}"))[order].astype('<u4'),
+            'kind': np.frombuffer(self._kinds, dtype=np.uint8)[order].astype('<u1'),
+            'osm_key': np.frombuffer(self._osm_keys, dtype=np.int64)[order].astype('<i8'),
+        }
+
+        blocks = []
+        header = {
+            'rows': len(self),
+            'code_precision': CODE_PRECISION,
+            'kinds': list(KINDS),
+            'created_at': time.time(),
+            'metadata': metadata or {},
+            'columns': {},
+            'strings': {}
+        }
+        for name, dtype in COLUMNS:
+            header['columns'][name] = {'dtype': dtype}
+            blocks.append((header['columns'][name], columns[name].tobytes()))
+        for field in STRING_FIELDS:
+            values = self._strings[field]
+            data = b''.join(values[row] for row in order.tolist())
+            offsets = np.zeros(len(values) + 1, dtype='<u8')
+            np.cumsum([len(values[row]) for row in order.tolist()], out=offsets[1:])
+            header['strings'][field] = {'offsets': {}, 'data': {}}
+            blocks.append((header['strings'][field]['offsets'], offsets.tobytes()))
+            blocks.append((header['strings'][field]['data'], data))
+
+        # Trigram index of the Thai and English names, see name_search
+        texts, text_rows = [], []
+        for new_row, row in enumerate(order.tolist()):
+            for field in ('name', 'name_en'):
+                text = search_text(self._strings[field][row].decode('utf-8'))
+                if text:
+                    texts.append(text)
+                    text_rows.append(new_row)
+        keys, offsets, postings = build_trigram_index(texts, text_rows)
+        header['name_index'] = {'keys': {}, 'offsets': {}, 'postings': {}}
+        blocks.append((header['name_index']['keys'], keys.astype('<u8').tobytes()))
+        blocks.append((header['name_index']['offsets'], offsets.astype('<u8').tobytes()))
+        blocks.append((header['name_index']['postings'], postings.astype('<u4').tobytes()))
+
+        # Offsets depend on the header length, which depends on the offsets;
+        # reserve room generously and pad the header to it
+        reserved = len(json.dumps(header)) + 64 * (len(blocks) + 1)
+        position = _align(len(MAGIC) + 4 + reserved)
+        for entry, data in blocks:
+            entry['offset'] = position
+            entry['size'] = len(data)
+            position = _align(position + len(data))
+        header_bytes = json.dumps(header).encode('utf-8').ljust(reserved)
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<I', len(header_bytes)))
+            f.write(header_bytes)
+            for entry, data in blocks:
+                f.write(b'\0' * (entry['offset'] - f.tell()))
+                f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        return len(self)
+
+
+def _align(position):
+    return (position + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def read_header(f):
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError('Not a restaurant store file')
+    header_length, = struct.unpack('<I', f.read(4))
+    return json.loads(f.read(header_length).decode('utf-8'))
+
+
+def _view(buffer, spec, dtype):
+    """Zero-copy array over the block of the mapping a header entry describes"""
+    dtype = np.dtype(dtype)
+    return np.frombuffer(buffer, dtype=dtype, count=spec['size'] // dtype.itemsize, offset=spec['offset'])
+
+
+class RestaurantStore:
+    """Read-only local restaurant dataset written by StoreWriter
+
+    The file is memory-mapped rather than read: columns are NumPy views
+    straight onto the mapping and strings are decoded only for the rows a
+    query returns, so every worker on a host shares the same page-cache copy
+    of the data instead of holding its own.
+
+    Answers radius queries without any network: the cells around the query
+    circle map to contiguous row ranges of the geohash-sorted columns, which
+    are then measured in one vectorized pass.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.header = read_header(f)
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buffer = memoryview(self._mmap)
+        self.columns = {}
+        for name, spec in self.header['columns'].items():
+            self.columns[name] = _view(buffer, spec, spec['dtype'])
+        self._strings = {}
+        for field, spec in self.header['strings'].items():
+            offsets = _view(buffer, spec['offsets'], '<u8')
+            data = buffer[spec['data']['offset']:spec['data']['offset'] + spec['data']['size']]
+            self._strings[field] = (offsets, data)
+        # Stores written before names were indexed cannot be searched by name
+        self.name_index = None
+        if 'name_index' in self.header:
+            spec = self.header['name_index']
+            self.name_index = (_view(buffer, spec['keys'], '<u8'), _view(buffer, spec['offsets'], '<u8'),
+                               _view(buffer, spec['postings'], '<u4'))
+        self.kinds = self.header['kinds']
+        self.code_precision = self.header['code_precision']
+
+    def close(self):
+        """Release the mapping; the store must not be used afterwards"""
+        self.columns = {}
+        self._strings = {}
+        self.name_index = None
+        try:
+            self._mmap.close()
+        except BufferError:
+            # Arrays handed out by earlier queries still point into it; the GC unmaps it later
+            pass
+
+    def __len__(self):
+        return self.header['rows']
+
+    def string(self, field, row):
+        offsets, data = self._strings[field]
+        return str(data[int(offsets[row]):int(offsets[row + 1])], 'utf-8') or None
+
+    def _cell_ranges(self, cells):
+        """Row ranges [(start, stop)] holding the given geohash cells"""
+        codes = self.columns['cell']
+        bounds = []
+        for cell in cells:
+            shift = 5 * (self.code_precision - len(cell))
+            low = geohash_to_int(cell) << shift
+            bounds.extend((low, low + (1 << shift)))
+        # One search, in the column's own dtype so the column is not converted on every call
+        positions = np.searchsorted(codes, np.array(bounds, dtype=np.int64).astype(codes.dtype)).tolist()
+        return [(start, stop) for start, stop in zip(positions[::2], positions[1::2]) if stop > start]
+
+    def radius_ranges(self, lat, lon, radius, max_cells=64):
+        """Row ranges [(start, stop)] covering a circle, from at most max_cells geohash cells"""
+        lat_span = radius / METERS_PER_DEGREE
+        lon_span = radius / (METERS_PER_DEGREE * max(np.cos(np.radians(min(abs(lat) + lat_span, 89.0))), 0.01))
+        for precision in range(self.code_precision, 0, -1):
+            cells = geohash_cells_in_bbox(lat - lat_span, lon - lon_span, lat + lat_span, lon + lon_span,
+                                          precision, max_cells=max_cells)
+            if cells is not None:
+                return self._cell_ranges(cells)
+        return self._cell_ranges([''])
+
+    def name_lengths(self, rows):
+        """Byte length of the shorter non-empty name variant of each row"""
+        lengths = []
+        for field in ('name', 'name_en'):
+            offsets, _ = self._strings[field]
+            lengths.append((offsets[rows + 1] - offsets[rows]).astype(np.int64))
+        name, name_en = lengths
+        return np.where(name == 0, name_en, np.where(name_en == 0, name, np.minimum(name, name_en)))
+
+    def radius_rows(self, lat, lon, radius, kinds=None, max_cells=64):
+        """Return (rows, distances) of restaurants within radius meters, nearest first
+
+        kinds optionally restricts the results to some amenity kinds (see KINDS).
+        """
+        ranges = self.radius_ranges(lat, lon, radius, max_cells)
+        if not ranges:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        rows = np.concatenate([np.arange(start, stop, dtype=np.int64) for start, stop in ranges])
+        distances = haversine_many(lat, lon, self.columns['lat'][rows], self.columns['lon'][rows])
+        inside = distances <= radius
+        if kinds is not None:
+            inside &= np.isin(self.columns['kind'][rows], [self.kinds.index(kind) for kind in kinds])
+        rows, distances = rows[inside], distances[inside]
+        order = np.lexsort((rows, distances))
+        return rows[order], distances[order]
+
+    def restaurant(self, row):
+        """A row as a restaurant dict shaped like the Places results"""
+        key = int(self.columns['osm_key'][row])
+        return {
+            'place_id': f"osm:{osm_ref(key)}",
+            'name': self.string('name', row) or self.string('name_en', row) or NO_NAME,
+            'name_en': self.string('name_en', row),
+            'rating': float(self.columns['rating'][row]),
+            'user_ratings_total': int(self.columns['reviews'][row]),
+            'vicinity': self.string('vicinity', row) or NO_VICINITY,
+            'lat': float(self.columns['lat'][row]),
+            'lng': float(self.columns['lon'][row]),
+            'cuisine': self.string('cuisine', row),
+            'source': 'osm'
+        }
+
+    def restaurants(self, rows):
+        return [self.restaurant(row) for row in rows.tolist()]
+
+    def stats(self):
+        return {
+            'path': self.path,
+            'rows': len(self),
+            'bytes': len(self._mmap),
+            'created_at': self.header['created_at'],
+            'metadata': self.header['metadata']
+        }
+
+
+def generation_path(link, generation):
+    return f"{link}.{generation:0{GENERATION_DIGITS}d}"
+
+
+def list_generations(link):
+    """[(generation, path)] written for a published path, oldest first"""
+    pattern = re.compile(re.escape(os.path.basename(link)) + r'\.(\d{%d})$' % GENERATION_DIGITS)
+    generations = []
+    for path in glob.glob(glob.escape(link) + '.*'):
+        match = pattern.match(os.path.basename(path))
+        if match:
+            generations.append((int(match.group(1)), path))
+    return sorted(generations)
+
+
+def publish(link, path):
+    """Point link at path with one atomic rename, so readers see the old or the new store, never neither"""
+    tmp_link = f"{link}.tmp-link"
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(os.path.basename(path), tmp_link)
+    os.replace(tmp_link, link)
+
+
+def write_generation(writer, link, metadata=None, keep=KEEP_GENERATIONS):
+    """Write writer's rows as the next generation of link, publish it and prune old ones
+
+    Workers still mapping a pruned generation keep reading it until they
+    notice the swap; the data stays on disk as long as it is mapped.
+    Returns the new generation number.
+    """
+    generations = list_generations(link)
+    generation = generations[-1][0] + 1 if generations else 1
+    path = generation_path(link, generation)
+    writer.write(path, metadata=dict(metadata or {}, generation=generation))
+    publish(link, path)
+    for _, old_path in generations[:max(len(generations) - (keep - 1), 0)]:
+        os.remove(old_path)
+    logger.info(f"Published generation {generation} of {link} with {len(writer)} restaurants")
+    return generation
+
+
+class LiveStore:
+    """The current RestaurantStore behind a published path, following generation swaps
+
+    current() stats the path at most every check_interval seconds and maps
+    the new generation when the symlink was repointed, which only costs an
+    mmap since generations are fully built before they are published.
+    Requests holding the previous store keep using it until they finish.
+    """
+
+    def __init__(self, path, check_interval=1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._store = None
+        self._identity = None
+        self._checked_at = 0
+        self._lock = Lock()
+
+    def current(self):
+        """The store of the current generation, or None when nothing is published"""
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return self._store
+
+        with self._lock:
+            if now - self._checked_at < self.check_interval:
+                return self._store
+            self._checked_at = now
+            # Resolve once so the file checked is the file mapped, even if the link moves meanwhile
+            target = os.path.realpath(self.path)
+            try:
+                stat = os.stat(target)
+                identity = (stat.st_dev, stat.st_ino, stat.st_mtime_ns)
+            except FileNotFoundError:
+                identity = None
+            if identity == self._identity:
+                return self._store
+
+            if identity is None:
+                store = None
+            else:
+                try:
+                    store = RestaurantStore(target)
+                except Exception as e:
+                    # Keep serving the generation we have; try again on the next check
+                    logger.error(f"Could not load restaurant dataset from {self.path}: {str(e)}")
+                    return self._store
+            if self._store is not None or store is not None:
+                generation = store.header['metadata'].get('generation') if store is not None else None
+                logger.info(f"Restaurant dataset at {self.path} now at generation {generation}")
+            self._store = store
+            self._identity = identity
+            return store
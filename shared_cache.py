@@ -0,0 +1,251 @@
+import json
+import logging
+import os
+import sqlite3
+import time
+from threading import Thread, local
+
+logger = logging.getLogger(__name__)
+
+# Only refresh an entry's access time when it is older than this, so reads stay read-only
+ACCESS_TOUCH_INTERVAL = 60
+
+
+class SharedCache:
+    """Disk-backed cache in SQLite (WAL mode) shared by all gunicorn workers on a host"""
+
+    def __init__(self, path, max_bytes=256 * 1024 * 1024, default_ttl=3600):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self._local = local()
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        conn = self._connection()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS cache_entries (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                expires_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_cache_expires ON cache_entries (expires_at)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_cache_accessed ON cache_entries (accessed_at)')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS rate_slots (
+                name TEXT PRIMARY KEY,
+                next_slot REAL NOT NULL
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS usage_counters (
+                name TEXT NOT NULL,
+                period TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (name, period)
+            )
+        ''')
+        conn.commit()
+
+    def _connection(self):
+        """Return this thread's SQLite connection, opening it on first use
+
+        Connections are never shared across a fork: a worker forked from a
+        preloading gunicorn master opens its own.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA busy_timeout=5000')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, namespace, key):
+        """Return the decoded value for (namespace, key), or None if missing or expired"""
+        entry = self.get_entry(namespace, key)
+        return entry[0] if entry is not None else None
+
+    def get_entry(self, namespace, key):
+        """Return (value, expires_at) for (namespace, key), or None if missing or expired"""
+        try:
+            conn = self._connection()
+            row = conn.execute(
+                'SELECT value, expires_at, accessed_at FROM cache_entries WHERE namespace = ? AND key = ?',
+                (namespace, key)
+            ).fetchone()
+            if row is None:
+                return None
+
+            value, expires_at, accessed_at = row
+            now = time.time()
+            if expires_at <= now:
+                return None
+
+            if now - accessed_at > ACCESS_TOUCH_INTERVAL:
+                conn.execute(
+                    'UPDATE cache_entries SET accessed_at = ? WHERE namespace = ? AND key = ?',
+                    (now, namespace, key)
+                )
+                conn.commit()
+            return json.loads(value), expires_at
+        except sqlite3.Error as e:
+            logger.warning(f"Shared cache read failed for {namespace}:{key}: {str(e)}")
+            return None
+
+    def set(self, namespace, key, value, ttl=None):
+        """Store a JSON-serialisable value under (namespace, key)"""
+        try:
+            # Stored and measured as UTF-8 bytes: Thai text takes three per character
+            encoded = json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            now = time.time()
+            expires_at = now + (self.default_ttl if ttl is None else ttl)
+            conn = self._connection()
+            conn.execute(
+                'INSERT OR REPLACE INTO cache_entries '
+                '(namespace, key, value, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)',
+                (namespace, key, encoded, len(encoded), expires_at, now)
+            )
+            conn.commit()
+            return True
+        except sqlite3.Error as e:
+            logger.warning(f"Shared cache write failed for {namespace}:{key}: {str(e)}")
+            return False
+
+    def delete(self, namespace, key):
+        conn = self._connection()
+        conn.execute('DELETE FROM cache_entries WHERE namespace = ? AND key = ?', (namespace, key))
+        conn.commit()
+
+    def reserve_slot(self, name, interval, max_delay, not_before=0):
+        """Reserve the next free slot of a rate limit shared by all workers
+
+        Slots are handed out interval seconds apart in arrival order. Returns the
+        delay in seconds until the reserved slot, or None (reserving nothing) if
+        that would be more than max_delay away.
+        """
+        conn = self._connection()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            now = time.time()
+            row = conn.execute('SELECT next_slot FROM rate_slots WHERE name = ?', (name,)).fetchone()
+            slot = max(now, not_before, row[0] if row else 0)
+            if slot - now > max_delay:
+                conn.rollback()
+                return None
+            conn.execute(
+                'INSERT OR REPLACE INTO rate_slots (name, next_slot) VALUES (?, ?)',
+                (name, slot + interval)
+            )
+            conn.commit()
+            return slot - now
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+
+    def consume(self, name, periods, amount=1):
+        """Atomically add amount to a set of usage counters shared by all workers
+
+        periods is [(period, limit, expires_at)] where period is the key of one
+        counting period (e.g. 'day:2024-05-01') and limit may be None for no limit.
+        Returns {period: count} after counting, or None (counting nothing) if
+        any counter would go over its limit.
+        """
+        conn = self._connection()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            counts = {}
+            for period, limit, expires_at in periods:
+                row = conn.execute('SELECT count FROM usage_counters WHERE name = ? AND period = ?',
+                                   (name, period)).fetchone()
+                counts[period] = (row[0] if row else 0) + amount
+                if limit is not None and counts[period] > limit:
+                    conn.rollback()
+                    return None
+            conn.executemany(
+                'INSERT OR REPLACE INTO usage_counters (name, period, count, expires_at) VALUES (?, ?, ?, ?)',
+                [(name, period, counts[period], expires_at) for period, _, expires_at in periods]
+            )
+            conn.commit()
+            return counts
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+
+    def read_counters(self, name, periods):
+        """Return {period: count} for the given counting periods (0 when unused)"""
+        conn = self._connection()
+        placeholders = ', '.join('?' for _ in periods)
+        rows = conn.execute(
+            f'SELECT period, count FROM usage_counters WHERE name = ? AND period IN ({placeholders})',
+            (name, *periods)
+        ).fetchall()
+        counts = dict.fromkeys(periods, 0)
+        counts.update(rows)
+        return counts
+
+    def compact(self):
+        """Drop expired entries, evict least recently used ones above the size cap and trim the WAL"""
+        conn = self._connection()
+        now = time.time()
+        expired = conn.execute('DELETE FROM cache_entries WHERE expires_at <= ?', (now,)).rowcount
+        conn.execute('DELETE FROM usage_counters WHERE expires_at <= ?', (now,))
+        conn.commit()
+
+        evicted = 0
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM cache_entries').fetchone()[0]
+        if total > self.max_bytes:
+            # Evict down to 90% of the cap so compaction does not run back to back
+            target = int(self.max_bytes * 0.9)
+            rows = conn.execute(
+                'SELECT namespace, key, size FROM cache_entries ORDER BY accessed_at'
+            ).fetchall()
+            victims = []
+            for namespace, key, size in rows:
+                if total <= target:
+                    break
+                victims.append((namespace, key))
+                total -= size
+            conn.executemany('DELETE FROM cache_entries WHERE namespace = ? AND key = ?', victims)
+            conn.commit()
+            evicted = len(victims)
+
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        logger.info(f"Shared cache compacted: {expired} expired, {evicted} evicted, {total} bytes kept")
+        return {'expired': expired, 'evicted': evicted, 'bytes': total}
+
+    def stats(self):
+        conn = self._connection()
+        entries, total = conn.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache_entries'
+        ).fetchone()
+        return {
+            'path': self.path,
+            'entries': entries,
+            'bytes': total,
+            'max_bytes': self.max_bytes
+        }
+
+    def start_compaction(self, interval=600):
+        """Run compact() periodically in a daemon thread"""
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.compact()
+                except Exception as e:
+                    logger.error(f"Shared cache compaction failed: {str(e)}")
+
+        thread = Thread(target=run, name='shared-cache-compaction', daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,325 @@
+import heapq
+import math
+import time
+from array import array
+from collections import OrderedDict
+from threading import RLock
+
+from geo import EARTH_RADIUS
+from lazy_imports import lazy_module
+from ranking import haversine_many
+
+np = lazy_module('numpy')
+
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+MAX_TAGS = 64
+
+
+class SpatialIndex:
+    """In-memory grid index of restaurants with radius and k-nearest queries
+
+    Coordinates live in growable NumPy columns and each grid bucket holds the
+    row numbers of the points inside it, so a query only gathers the buckets
+    its circle touches and measures them in one vectorized pass. Items can be
+    tagged (e.g. with the place type and language they were fetched for) and
+    queries can be restricted to one tag.
+
+    As items are added, those not added again within item_ttl seconds are
+    dropped, and past max_items the least recently added ones are, so closed
+    or moved places do not linger and memory stays bounded. Dropping an item
+    uncovers the areas whose fetch it came from.
+    """
+
+    def __init__(self, cell_size=0.01, capacity=1024, max_items=200000, item_ttl=None):
+        self.cell_size = cell_size  # degrees, ~1.1km at the equator
+        self.max_items = max_items
+        self.item_ttl = item_ttl
+        self._size = 0
+        self._capacity = capacity
+        # Columns are allocated on the first insert so NumPy is not needed at startup
+        self._lats = None
+        self._lons = None
+        self._tag_bits = None
+        self._items = []
+        self._rows = {}
+        self._free_rows = []
+        self._added = OrderedDict()  # key -> time it was last added, oldest first
+        self._dropped_until = 0.0  # latest add time of a dropped item
+        # Per bucket, bumped whenever what queries over it return changes (see bbox_version)
+        self._bucket_versions = {}
+        self._tag_ids = {}
+        self._buckets = {}
+        self._coverage = {}
+        self._bucket_bounds = None  # (min_by, min_bx, max_by, max_bx)
+        self._lock = RLock()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _bucket(self, lat, lon):
+        return int(math.floor(lat / self.cell_size)), int(math.floor(lon / self.cell_size))
+
+    def _tag_bit(self, tag, create=False):
+        bit = self._tag_ids.get(tag)
+        if bit is None and create:
+            if len(self._tag_ids) >= MAX_TAGS:
+                raise ValueError(f"SpatialIndex supports at most {MAX_TAGS} distinct tags")
+            bit = np.uint64(1 << len(self._tag_ids))
+            self._tag_ids[tag] = bit
+        return bit
+
+    def _grow(self):
+        if self._lats is None:
+            self._lats = np.zeros(self._capacity, dtype=np.float64)
+            self._lons = np.zeros(self._capacity, dtype=np.float64)
+            self._tag_bits = np.zeros(self._capacity, dtype=np.uint64)
+            return
+
+        capacity = len(self._lats) * 2
+        for name in ('_lats', '_lons', '_tag_bits'):
+            column = getattr(self, name)
+            grown = np.zeros(capacity, dtype=column.dtype)
+            grown[:len(column)] = column
+            setattr(self, name, grown)
+
+    def add(self, key, lat, lon, item, tag=None):
+        """Insert or update an item identified by key"""
+        with self._lock:
+            bit = self._tag_bit(tag, create=True) if tag is not None else np.uint64(0)
+            now = time.time()
+            self._added[key] = now
+            self._added.move_to_end(key)
+            self._expire(now)
+            row = self._rows.get(key)
+            if row is None:
+                self._bump(self._bucket(lat, lon))
+                if self._free_rows:
+                    row = self._free_rows.pop()
+                    self._items[row] = item
+                else:
+                    if self._lats is None or self._size == len(self._lats):
+                        self._grow()
+                    row = self._size
+                    self._size += 1
+                    self._items.append(item)
+                self._rows[key] = row
+                self._tag_bits[row] = bit
+            else:
+                old_bucket = self._bucket(self._lats[row], self._lons[row])
+                if (item != self._items[row] or self._lats[row] != lat or self._lons[row] != lon
+                        or (self._tag_bits[row] & bit) != bit):
+                    self._bump(old_bucket)
+                    self._bump(self._bucket(lat, lon))
+                self._items[row] = item
+                self._tag_bits[row] |= bit
+                if old_bucket == self._bucket(lat, lon):
+                    self._lats[row] = lat
+                    self._lons[row] = lon
+                    return
+                self._buckets[old_bucket].remove(row)
+
+            self._lats[row] = lat
+            self._lons[row] = lon
+            by, bx = self._bucket(lat, lon)
+            self._buckets.setdefault((by, bx), array('q')).append(row)
+            if self._bucket_bounds is None:
+                self._bucket_bounds = (by, bx, by, bx)
+            else:
+                min_by, min_bx, max_by, max_bx = self._bucket_bounds
+                self._bucket_bounds = (min(min_by, by), min(min_bx, bx), max(max_by, by), max(max_bx, bx))
+
+    def _expire(self, now):
+        """Drop the items added longest ago while over max_items or older than item_ttl"""
+        while self._added:
+            key, added_at = next(iter(self._added.items()))
+            if len(self._added) <= self.max_items and (self.item_ttl is None or added_at > now - self.item_ttl):
+                break
+            del self._added[key]
+            self._dropped_until = max(self._dropped_until, added_at)
+            row = self._rows.pop(key, None)
+            if row is None:
+                continue
+            bucket = self._bucket(self._lats[row], self._lons[row])
+            self._bump(bucket)
+            self._buckets[bucket].remove(row)
+            self._items[row] = None
+            self._tag_bits[row] = 0
+            self._free_rows.append(row)
+
+    def _bump(self, bucket):
+        self._bucket_versions[bucket] = self._bucket_versions.get(bucket, 0) + 1
+
+    def bbox_version(self, south, west, north, east):
+        """A number that changes whenever what a query over the bounding box could return does
+
+        Versions are kept per bucket and only ever grow, so their sum over
+        the buckets the box touches changes with any of them; results over
+        a small box can be cached under it without querying the index.
+        """
+        min_by, min_bx = self._bucket(south, west)
+        max_by, max_bx = self._bucket(north, east)
+        with self._lock:
+            return sum(self._bucket_versions.get((by, bx), 0)
+                       for by in range(min_by, max_by + 1) for bx in range(min_bx, max_bx + 1))
+
+    def _gather(self, bucket_keys, tag):
+        """Row numbers of the given buckets, restricted to tag, as an int64 array (None if empty)"""
+        parts = [np.frombuffer(self._buckets[key], dtype=np.int64)
+                 for key in bucket_keys if self._buckets.get(key)]
+        if not parts:
+            return None
+        rows = np.concatenate(parts)
+        if tag is not None:
+            bit = self._tag_bit(tag)
+            if bit is None:
+                return None
+            rows = rows[(self._tag_bits[rows] & bit) != 0]
+        return rows
+
+    def _ring_keys(self, center_bucket, ring):
+        """Bucket keys in the square ring at Chebyshev distance ring"""
+        cy, cx = center_bucket
+        for by in range(cy - ring, cy + ring + 1):
+            if ring == 0 or by in (cy - ring, cy + ring):
+                for bx in range(cx - ring, cx + ring + 1):
+                    yield by, bx
+            else:
+                yield by, cx - ring
+                yield by, cx + ring
+
+    def _ring_clearance(self, lat, ring):
+        """Lower bound in meters from a point to any bucket outside rings 0..ring around it"""
+        lon_scale = max(math.cos(math.radians(min(abs(lat) + ring * self.cell_size, 89.0))), 0.01)
+        return ring * self.cell_size * METERS_PER_DEGREE * lon_scale
+
+    def radius_rows(self, lat, lon, radius, tag=None):
+        """Return (rows, distances) of items within radius meters, nearest first"""
+        lat_span = radius / METERS_PER_DEGREE
+        lon_span = radius / (METERS_PER_DEGREE * max(math.cos(math.radians(min(abs(lat) + lat_span, 89.0))), 0.01))
+        min_by, min_bx = self._bucket(lat - lat_span, lon - lon_span)
+        max_by, max_bx = self._bucket(lat + lat_span, lon + lon_span)
+
+        with self._lock:
+            keys = [(by, bx) for by in range(min_by, max_by + 1) for bx in range(min_bx, max_bx + 1)]
+            rows = self._gather(keys, tag)
+            if rows is None:
+                return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+            distances = haversine_many(lat, lon, self._lats[rows], self._lons[rows])
+
+        inside = distances <= radius
+        rows, distances = rows[inside], distances[inside]
+        order = np.lexsort((rows, distances))
+        return rows[order], distances[order]
+
+    def bbox_rows(self, south, west, north, east, tag=None):
+        """Return the rows of items inside a bounding box, in insertion order"""
+        min_by, min_bx = self._bucket(south, west)
+        max_by, max_bx = self._bucket(north, east)
+
+        with self._lock:
+            if (max_by - min_by + 1) * (max_bx - min_bx + 1) > len(self._buckets):
+                # Large boxes: scanning the occupied buckets is cheaper than the grid range
+                keys = [(by, bx) for by, bx in self._buckets
+                        if min_by <= by <= max_by and min_bx <= bx <= max_bx]
+            else:
+                keys = [(by, bx) for by in range(min_by, max_by + 1) for bx in range(min_bx, max_bx + 1)]
+            rows = self._gather(keys, tag)
+            if rows is None:
+                return np.empty(0, dtype=np.int64)
+            lats, lons = self._lats[rows], self._lons[rows]
+
+        inside = (lats >= south) & (lats <= north) & (lons >= west) & (lons <= east)
+        return np.sort(rows[inside])
+
+    def nearest_rows(self, lat, lon, k, max_radius=None, tag=None):
+        """Return (rows, distances) of the k nearest items, optionally within max_radius meters"""
+        empty = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        if k <= 0:
+            return empty
+
+        center = self._bucket(lat, lon)
+        heap = []  # max-heap on distance via negation, holds the best k so far
+        with self._lock:
+            if self._bucket_bounds is None:
+                return empty
+            min_by, min_bx, max_by, max_bx = self._bucket_bounds
+            max_ring = max(abs(center[0] - min_by), abs(center[0] - max_by),
+                           abs(center[1] - min_bx), abs(center[1] - max_bx))
+
+            for ring in range(max_ring + 1):
+                rows = self._gather(self._ring_keys(center, ring), tag)
+                if rows is not None and len(rows):
+                    distances = haversine_many(lat, lon, self._lats[rows], self._lons[rows])
+                    for row, distance in zip(rows.tolist(), distances.tolist()):
+                        if max_radius is not None and distance > max_radius:
+                            continue
+                        if len(heap) < k:
+                            heapq.heappush(heap, (-distance, -row))
+                        elif -heap[0][0] > distance:
+                            heapq.heapreplace(heap, (-distance, -row))
+
+                # Everything not yet scanned is at least this far away
+                clearance = self._ring_clearance(lat, ring)
+                if len(heap) == k and -heap[0][0] <= clearance:
+                    break
+                if max_radius is not None and clearance > max_radius:
+                    break
+
+        best = sorted((-d, -r) for d, r in heap)
+        return (np.array([row for _, row in best], dtype=np.int64),
+                np.array([distance for distance, _ in best], dtype=np.float64))
+
+    def items(self, rows):
+        """Return the items stored at the given row numbers"""
+        with self._lock:
+            return [self._items[row] for row in rows.tolist()]
+
+    def coordinates(self, rows):
+        """Return (lats, lons) arrays of the given row numbers"""
+        with self._lock:
+            if self._lats is None:
+                return np.empty(0, dtype=np.float64), np.empty(0, dtype=np.float64)
+            return self._lats[rows], self._lons[rows]
+
+    def radius(self, lat, lon, radius, tag=None):
+        """Return [(distance, item)] within radius meters, nearest first"""
+        rows, distances = self.radius_rows(lat, lon, radius, tag=tag)
+        return list(zip(distances.tolist(), self.items(rows)))
+
+    def nearest(self, lat, lon, k, max_radius=None, tag=None):
+        """Return the k nearest [(distance, item)], optionally limited to max_radius meters"""
+        rows, distances = self.nearest_rows(lat, lon, k, max_radius=max_radius, tag=tag)
+        return list(zip(distances.tolist(), self.items(rows)))
+
+    def mark_covered(self, area, radius, tag=None, ttl=900, since=None):
+        """Record that area (e.g. a geohash cell) was fully fetched for radius meters
+
+        since is when the fetch's items started being added (default now);
+        the area is uncovered again once an item added after that is dropped.
+        """
+        now = time.time()
+        with self._lock:
+            self._coverage[(area, tag)] = (radius, now + ttl, now if since is None else since)
+            if len(self._coverage) > 2 * self.max_items:
+                self._coverage = {key: coverage for key, coverage in self._coverage.items() if coverage[1] > now}
+
+    def is_covered(self, area, radius, tag=None):
+        """True if area was fetched for at least radius meters, that fetch has not expired
+        and none of the items it added were dropped since"""
+        with self._lock:
+            coverage = self._coverage.get((area, tag))
+            dropped_until = self._dropped_until
+        if coverage is None:
+            return False
+        covered_radius, expires_at, since = coverage
+        return covered_radius >= radius and expires_at > time.time() and since > dropped_until
+
+    def stats(self):
+        with self._lock:
+            return {
+                'items': len(self._rows),
+                'max_items': self.max_items,
+                'buckets': len(self._buckets),
+                'tags': len(self._tag_ids),
+                'covered_areas': len(self._coverage)
+            }
@@ -0,0 +1,25 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES_DIR = os.path.join(ROOT, 'fixtures')
+
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(scope='session')
+def app_module(tmp_path_factory):
+    """The app module, imported with its data directory and caches in a temporary folder"""
+    data_dir = tmp_path_factory.mktemp('app')
+    os.environ['SHARED_CACHE_FILE'] = str(data_dir / 'shared_cache.sqlite3')
+    os.environ['BOUNDARIES_FILE'] = str(data_dir / 'admin_boundaries.geojson')
+    os.environ['LOCAL_DATASET_FILE'] = str(data_dir / 'restaurants.rstore')
+    cwd = os.getcwd()
+    os.chdir(data_dir)
+    try:
+        import app
+    finally:
+        os.chdir(cwd)
+    return app
@@ -0,0 +1,66 @@
+import os
+
+import pytest
+
+from boundaries import BoundaryIndex
+from conftest import FIXTURES_DIR
+
+SAMPLE_FILE = os.path.join(FIXTURES_DIR, 'admin_boundaries_sample.geojson')
+
+
+@pytest.fixture(scope='module')
+def boundaries():
+    return BoundaryIndex.from_file(SAMPLE_FILE)
+
+
+def names(areas):
+    return {level: area['name_en'] for level, area in areas.items()}
+
+
+def test_point_inside_district(boundaries):
+    assert names(boundaries.lookup(13.83, 100.565)) == {
+        'subdistrict': 'Lat Yao', 'district': 'Chatuchak', 'province': 'Bangkok'
+    }
+    assert boundaries.address(13.83, 100.565) == 'แขวงลาดยาว, เขตจตุจักร, กรุงเทพมหานคร, ประเทศไทย'
+    assert boundaries.address(13.83, 100.565, language='en') == 'Lat Yao, Chatuchak, Bangkok, Thailand'
+
+
+def test_point_in_hole_is_outside_its_subdistrict(boundaries):
+    assert names(boundaries.lookup(13.7275, 100.5425)) == {'district': 'Pathum Wan', 'province': 'Bangkok'}
+    assert names(boundaries.lookup(13.7475, 100.5475))['subdistrict'] == 'Lumphini'
+
+
+@pytest.mark.parametrize('lon', [100.4, 100.465, 100.5])
+def test_point_on_shared_border_gets_one_province(boundaries, lon):
+    # On the edge Bangkok and Nonthaburi share, from (100.33, 13.82) to (100.6, 13.96)
+    lat = 13.82 + (lon - 100.33) * (13.96 - 13.82) / (100.6 - 100.33)
+    areas = boundaries.lookup(lat, lon)
+    assert areas is not None
+    assert areas['province']['name_en'] in ('Bangkok', 'Nonthaburi')
+
+
+def test_point_outside_every_polygon(boundaries):
+    assert boundaries.lookup(12.0, 99.0) is None
+    assert boundaries.address(12.0, 99.0) is None
+
+
+def test_get_location_falls_back_to_nominatim_outside_polygons(app_module, boundaries, monkeypatch):
+    lookups = []
+
+    def reverse_geocode(lat, lon, language=None):
+        lookups.append((float(lat), float(lon)))
+        return 'Nominatim address'
+
+    monkeypatch.setattr(app_module, 'boundary_index', boundaries)
+    monkeypatch.setattr(app_module, 'reverse_geocode', reverse_geocode)
+    client = app_module.app.test_client()
+
+    inside = client.get('/get_location?lat=13.83&lon=100.565').get_json()
+    assert inside['source'] == 'offline'
+    assert inside['address'].startswith('แขวงลาดยาว')
+    assert lookups == []
+
+    outside = client.get('/get_location?lat=12.0&lon=99.0').get_json()
+    assert outside['source'] == 'nominatim'
+    assert outside['address'] == 'Nominatim address'
+    assert lookups == [(12.0, 99.0)]
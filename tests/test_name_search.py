@@ -0,0 +1,97 @@
+import random
+
+import pytest
+
+from name_search import NameIndex, Query, search_store
+from restaurant_store import RestaurantStore, StoreWriter, osm_key
+
+BANGKOK = (13.7466, 100.5393)
+
+NAMES = [
+    ('ส้มตำป้าแดง', 'Pa Daeng Som Tam'),
+    ('ข้าวมันไก่ประตูน้ำ', 'Pratunam Chicken Rice'),
+    ('ก๋วยเตี๋ยวเรือป้าตำ', None),
+    ('ร้านกาแฟสด', 'Café Crème'),
+    ('ครัวคุณยาย', 'Grandma Kitchen'),
+]
+
+
+def names_of(results):
+    return [restaurant['name'] for _, restaurant in results]
+
+
+@pytest.fixture
+def index():
+    index = NameIndex()
+    for i, (name, _) in enumerate(NAMES):
+        index.add(f'place{i}', {'name': name, 'lat': BANGKOK[0], 'lng': BANGKOK[1] + i * 0.001,
+                                'rating': 4.0, 'user_ratings_total': 10})
+    for i, (_, name_en) in enumerate(NAMES):
+        if name_en:
+            index.add(f'place{i}', {'name': name_en, 'lat': BANGKOK[0], 'lng': BANGKOK[1] + i * 0.001,
+                                    'rating': 4.0, 'user_ratings_total': 10}, language='en')
+    return index
+
+
+def test_thai_substring_matches(index):
+    assert names_of(index.search(Query('มันไก่'))) == ['ข้าวมันไก่ประตูน้ำ']
+    assert set(names_of(index.search(Query('ป้า')))) == {'ส้มตำป้าแดง', 'ก๋วยเตี๋ยวเรือป้าตำ'}
+
+
+def test_two_characters_match_word_prefixes_only(index):
+    assert names_of(index.search(Query('Gr'))) == ['ครัวคุณยาย']
+    # "ma" is inside "Grandma" but starts no word
+    assert names_of(index.search(Query('ma'))) == []
+
+
+def test_latin_accents_are_folded(index):
+    assert names_of(index.search(Query('creme'))) == ['ร้านกาแฟสด']
+    assert names_of(index.search(Query('CAFÉ'))) == ['ร้านกาแฟสด']
+
+
+def test_english_fetch_keeps_thai_name_searchable(index):
+    results = index.search(Query('ส้มตำ'))
+    assert names_of(results) == ['ส้มตำป้าแดง']
+    assert results[0][1]['name_en'] == 'Pa Daeng Som Tam'
+    assert names_of(index.search(Query('som tam'))) == ['ส้มตำป้าแดง']
+
+
+def test_radius_cut(index):
+    index.add('far', {'name': 'ส้มตำเชียงใหม่', 'lat': 18.79, 'lng': 98.98})
+    assert set(names_of(index.search(Query('ส้มตำ')))) == {'ส้มตำป้าแดง', 'ส้มตำเชียงใหม่'}
+    near = index.search(Query('ส้มตำ'), *BANGKOK, radius=5000)
+    assert names_of(near) == ['ส้มตำป้าแดง']
+    assert near[0][1]['distance'] == 0
+
+
+def test_moved_and_dropped_restaurants_leave_the_results():
+    index = NameIndex(max_items=2)
+    index.add('a', {'name': 'ส้มตำ', 'lat': BANGKOK[0], 'lng': BANGKOK[1]})
+    index.add('a', {'name': 'ส้มตำ', 'lat': 18.79, 'lng': 98.98})
+    assert index.search(Query('ส้มตำ'), *BANGKOK, radius=5000) == []
+    index.add('b', {'name': 'ข้าวมันไก่', 'lat': BANGKOK[0], 'lng': BANGKOK[1]})
+    index.add('c', {'name': 'ก๋วยเตี๋ยว', 'lat': BANGKOK[0], 'lng': BANGKOK[1]})
+    assert len(index) == 2
+    assert index.search(Query('ส้มตำ')) == []
+
+
+def test_store_index_finds_every_matching_name(tmp_path):
+    random.seed(7)
+    syllables = ['ส้ม', 'ตำ', 'ไก่', 'ข้าว', 'มัน', 'ป้า', 'เรือ', 'ครัว', 'noodle', 'cafe', 'thai']
+    writer = StoreWriter()
+    names = []
+    for i in range(2000):
+        name = ''.join(random.sample(syllables, 3))
+        names.append(name)
+        writer.add(BANGKOK[0] + random.uniform(-0.2, 0.2), BANGKOK[1] + random.uniform(-0.2, 0.2),
+                   'restaurant', osm_key('node', i + 1), name=name)
+    path = tmp_path / 'restaurants.rstore'
+    writer.write(str(path))
+    store = RestaurantStore(str(path))
+    try:
+        for query in ('ข้าวมัน', 'ตำป้า', 'noodlecafe', 'ไก่'):
+            expected = sorted(name for name in names if query in name)
+            found = sorted(names_of(search_store(store, Query(query), limit=len(names))))
+            assert found == expected
+    finally:
+        store.close()
@@ -0,0 +1,150 @@
+import asyncio
+import os
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from threading import Lock, Thread
+
+from lazy_imports import lazy_module
+
+aiohttp = lazy_module('aiohttp')
+
+PLACES_NEARBY_URL = 'https://maps.googleapis.com/maps/api/place/nearbysearch/json'
+NOMINATIM_REVERSE_URL = 'https://nominatim.openstreetmap.org/reverse'
+
+
+class ApiError(Exception):
+    """An upstream API answered with an error status"""
+
+    def __init__(self, status, message=None):
+        super().__init__(f"{status}: {message}" if message else status)
+        self.status = status
+        self.message = message
+
+
+class UpstreamClient:
+    """Asynchronous client for Google Places and Nominatim
+
+    All requests run on one event loop in a background thread, with a pooled
+    keep-alive session, connection limit and concurrency limit per upstream
+    host. Flask views call the blocking wrappers (places_nearby, reverse),
+    which park the calling thread until the answer arrives, so a worker has
+    at most as many calls in flight as threads calling; max_concurrency is
+    meant to be sized to that. What the loop adds is connection reuse
+    across those threads, not more concurrency than they provide.
+    """
+
+    def __init__(self, google_api_key=None, user_agent='restaurant_finder_app',
+                 timeout=10, connections_per_host=50, max_concurrency=200):
+        self.google_api_key = google_api_key
+        self.user_agent = user_agent
+        self.timeout = timeout
+        self.connections_per_host = connections_per_host
+        self.max_concurrency = max_concurrency
+        self._loop = None
+        self._pid = None
+        self._sessions = {}
+        self._limits = {}
+        self._lock = Lock()
+
+    def _ensure_loop(self):
+        """Start the event loop thread, again after a fork since threads do not survive it"""
+        with self._lock:
+            if self._loop is not None and self._pid == os.getpid():
+                return self._loop
+
+            loop = asyncio.new_event_loop()
+            thread = Thread(target=loop.run_forever, name='upstream-loop', daemon=True)
+            thread.start()
+            self._loop = loop
+            self._pid = os.getpid()
+            self._sessions = {}
+            self._limits = {}
+            return loop
+
+    def run(self, coro, timeout=None):
+        """Run a coroutine on the client's loop and block until it finishes"""
+        loop = self._ensure_loop()
+        future = asyncio.run_coroutine_threadsafe(coro, loop)
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise
+
+    def close(self):
+        """Close pooled connections and stop the loop thread"""
+        with self._lock:
+            loop = self._loop if self._pid == os.getpid() else None
+            sessions = list(self._sessions.values())
+            self._loop = None
+            self._sessions = {}
+            self._limits = {}
+        if loop is None:
+            return
+
+        async def close_sessions():
+            for session in sessions:
+                await session.close()
+
+        asyncio.run_coroutine_threadsafe(close_sessions(), loop).result(5)
+        loop.call_soon_threadsafe(loop.stop)
+
+    def _session(self, host):
+        """Per-host session and semaphore, created on the loop thread"""
+        session = self._sessions.get(host)
+        if session is None:
+            connector = aiohttp.TCPConnector(limit=self.connections_per_host, ttl_dns_cache=300)
+            session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={'User-Agent': self.user_agent}
+            )
+            self._sessions[host] = session
+            self._limits[host] = asyncio.Semaphore(self.max_concurrency)
+        return session, self._limits[host]
+
+    async def _get_json(self, host, url, params, timeout=None):
+        session, limit = self._session(host)
+        kwargs = {'timeout': aiohttp.ClientTimeout(total=timeout)} if timeout else {}
+        async with limit:
+            async with session.get(url, params=params, **kwargs) as response:
+                response.raise_for_status()
+                return await response.json(content_type=None)
+
+    async def places_nearby_async(self, location=None, radius=None, type=None, language=None, page_token=None):
+        """Google Places Nearby Search; returns the decoded response"""
+        if not self.google_api_key:
+            raise RuntimeError('GOOGLE_MAPS_API_KEY is not configured')
+
+        params = {'key': self.google_api_key}
+        if page_token:
+            params['pagetoken'] = page_token
+        else:
+            params['location'] = f"{location[0]},{location[1]}"
+            params['radius'] = radius
+            if type:
+                params['type'] = type
+            if language:
+                params['language'] = language
+
+        result = await self._get_json('places', PLACES_NEARBY_URL, params)
+        status = result.get('status')
+        if status not in ('OK', 'ZERO_RESULTS'):
+            raise ApiError(status, result.get('error_message'))
+        return result
+
+    async def reverse_async(self, lat, lon, language=None, timeout=None):
+        """Nominatim reverse geocoding; returns the decoded result or None when nothing is found"""
+        params = {'format': 'jsonv2', 'lat': lat, 'lon': lon}
+        if language:
+            params['accept-language'] = language
+
+        result = await self._get_json('nominatim', NOMINATIM_REVERSE_URL, params, timeout=timeout)
+        if not result or 'error' in result:
+            return None
+        return result
+
+    def places_nearby(self, **kwargs):
+        return self.run(self.places_nearby_async(**kwargs))
+
+    def reverse(self, lat, lon, language=None, timeout=None):
+        return self.run(self.reverse_async(lat, lon, language=language, timeout=timeout))